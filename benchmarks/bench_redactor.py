@@ -0,0 +1,293 @@
+"""
+bench_redactor.py
+Benchmarks for the redaction detectors.  The script generates a synthetic corpus of
+documents with known densities of phone numbers, email addresses, street addresses,
+dates, names and gendered words, then measures the throughput (documents and MB per
+second) and peak Python memory of each redact_* function and of the full redactor
+command line pipeline.  Results can be saved as JSON and compared with the results
+from another commit:
+
+     python3 benchmarks/bench_redactor.py --json before.json
+     python3 benchmarks/bench_redactor.py --json after.json --compare before.json
+
+coding = utf-8
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from redactor import redactor
+
+FIRST_NAMES = ['John', 'Mary', 'Steve', 'Linda', 'Robert', 'Susan', 'Michael', 'Karen', 'David', 'Nancy',
+               'James', 'Betty', 'William', 'Helen', 'Richard', 'Sandra']
+LAST_NAMES = ['Smith', 'Johnson', 'Rogers', 'Brown', 'Miller', 'Davis', 'Wilson', 'Moore', 'Taylor',
+              'Anderson', 'Thomas', 'Jackson', 'White', 'Harris', 'Martin', 'Thompson']
+STREETS = ['Main St', 'Oak Avenue', 'Mockingbird Lane', 'Elm Street', 'Park Road', 'Maple Drive']
+CITIES = [('Norman', 'OK'), ('Los Angeles', 'CA'), ('Austin', 'TX'), ('Denver', 'CO'), ('Boston', 'MA')]
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September',
+          'October', 'November', 'December']
+FILLER = ['the', 'report', 'was', 'filed', 'after', 'a', 'long', 'meeting', 'about', 'budget', 'and',
+          'schedule', 'with', 'several', 'people', 'from', 'our', 'office', 'who', 'discussed', 'project',
+          'plans', 'for', 'next', 'quarter', 'in', 'detail', 'while', 'reviewing', 'child', 'care', 'costs']
+
+# Items per 1000 words for each kind of sensitive information
+DEFAULT_DENSITIES = dict(phone=5, email=5, address=3, date=5, name=10, gender=10)
+
+
+def _phone(rng):
+    return '(%03d) %03d-%04d' % (rng.randint(200, 999), rng.randint(200, 999), rng.randint(0, 9999))
+
+
+def _email(rng):
+    return '%s.%s@example.com' % (rng.choice(FIRST_NAMES).lower(), rng.choice(LAST_NAMES).lower())
+
+
+def _address(rng):
+    city, state = rng.choice(CITIES)
+    return '%d %s, %s, %s %05d' % (rng.randint(1, 9999), rng.choice(STREETS), city, state,
+                                   rng.randint(10000, 99999))
+
+
+def _date(rng):
+    if rng.random() < 0.5:
+        return '%d/%d/%d' % (rng.randint(1, 12), rng.randint(1, 28), rng.randint(1950, 2020))
+    return '%s %d, %d' % (rng.choice(MONTHS), rng.randint(1, 28), rng.randint(1950, 2020))
+
+
+def _name(rng):
+    return rng.choice(FIRST_NAMES) + ' ' + rng.choice(LAST_NAMES)
+
+
+def _gender(rng):
+    return rng.choice(redactor.MALE_TERMS + redactor.FEMALE_TERMS)
+
+
+GENERATORS = dict(phone=_phone, email=_email, address=_address, date=_date, name=_name, gender=_gender)
+
+
+def generate_document(size, densities=None, rng=None):
+    """
+    generate_document
+    :param size: approximate document size in characters
+    :param densities: dictionary of items per 1000 words for each kind of information
+    :param rng: random.Random instance
+    :return: (text, counts) where counts is the number of items inserted of each kind
+    Builds a document of filler sentences with sensitive items inserted at the
+    requested densities.
+    """
+    densities = DEFAULT_DENSITIES if densities is None else densities
+    rng = rng or random.Random(0)
+    counts = dict((kind, 0) for kind in densities)
+    total = sum(densities.values()) / 1000.0
+    sentences = []
+    length = 0
+    while length < size:
+        words = []
+        for i in range(rng.randint(8, 20)):
+            if rng.random() < total:
+                kind = rng.choices(list(densities), weights=list(densities.values()))[0]
+                words.append(GENERATORS[kind](rng))
+                counts[kind] += 1
+            else:
+                words.append(rng.choice(FILLER))
+        sentence = ' '.join(words) + '.'
+        sentence = sentence[0].upper() + sentence[1:]
+        sentences.append(sentence)
+        length += len(sentence) + 1
+    return ' '.join(sentences), counts
+
+
+def generate_corpus(directory, count, size, densities=None, seed=0):
+    """
+    generate_corpus
+    :param directory: directory the *.txt files are written to
+    :param count: number of documents
+    :param size: approximate size of each document in characters
+    :return: dictionary of the total number of items inserted of each kind
+    """
+    rng = random.Random(seed)
+    totals = {}
+    for i in range(count):
+        text, counts = generate_document(size, densities, rng)
+        with open(os.path.join(directory, 'doc%05d.txt' % i), 'w', encoding='utf-8') as f:
+            f.write(text)
+        for kind in counts:
+            totals[kind] = totals.get(kind, 0) + counts[kind]
+    return totals
+
+
+def measure(func, documents, repeat=1):
+    """
+    measure
+    :param func: function called with each document
+    :param documents: list of document strings
+    :param repeat: number of timed runs, the fastest is reported
+    :return: dictionary of throughput and peak memory results
+    """
+    megabytes = sum(len(doc.encode('utf-8')) for doc in documents) / 1e6
+    func(documents[0])  # Load any models before timing
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        for doc in documents:
+            func(doc)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    # Peak memory is measured in a separate run because tracing slows everything down
+    tracemalloc.start()
+    for doc in documents:
+        func(doc)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return dict(seconds=best, docs_per_sec=len(documents) / best, mb_per_sec=megabytes / best,
+                peak_memory_mb=peak / 1e6)
+
+
+def measure_pipeline(directory, flags, workers=1, repeat=1):
+    """
+    measure_pipeline
+    :param directory: directory holding the generated corpus
+    :param flags: list of redactor command line flags
+    :param workers: number of worker processes
+    :param repeat: number of timed runs, the fastest is reported
+    :return: dictionary of throughput and peak memory results
+    Runs the redactor command line entry point over the corpus.  With more than one
+    worker the peak memory is that of the parent process only.
+    """
+    files = [f for f in os.listdir(directory) if f.endswith('.txt')]
+    megabytes = sum(os.path.getsize(os.path.join(directory, f)) for f in files) / 1e6
+    outdir = tempfile.mkdtemp()
+    # --force, so that every run redacts the files again instead of reusing the manifest
+    argv = ['--input', os.path.join(directory, ''), '--output', outdir, '--workers', str(workers),
+            '--force'] + flags
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return redactor.run_redactor(argv)
+
+    try:
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            status = run()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        # Peak memory is measured in a separate run because tracing slows everything down
+        tracemalloc.start()
+        run()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(outdir)
+    return dict(seconds=best, docs_per_sec=len(files) / best, mb_per_sec=megabytes / best,
+                peak_memory_mb=peak / 1e6, peak_memory_scope='parent' if workers > 1 else 'process',
+                status=status)
+
+
+def detector_benchmarks(concept, concepts):
+    return [
+        ('redact_phone_numbers', redactor.redact_phone_numbers),
+        ('redact_email_addresses', redactor.redact_email_addresses),
+        ('redact_addresses', redactor.redact_addresses),
+        ('redact_dates', redactor.redact_dates),
+        ('redact_regex', lambda doc: redactor.redact_regex(doc, ['phone', 'email', 'address', 'date'])),
+        ('redact_gender', redactor.redact_gender),
+        ('redact_names', redactor.redact_names),
+        ('redact_concept', lambda doc: redactor.redact_concept(doc, concept)),
+        ('redact_concepts', lambda doc: redactor.redact_concept(doc, concepts)),
+    ]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline):
+    """Prints the change in throughput of each benchmark against a baseline result file"""
+    print("\nChange in MB/sec against " + str(baseline.get('commit')))
+    for name, result in sorted(results['benchmarks'].items()):
+        old = baseline['benchmarks'].get(name)
+        if old:
+            change = (result['mb_per_sec'] / old['mb_per_sec'] - 1) * 100
+            print("  %-24s %+8.1f%%" % (name, change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the redaction detectors")
+    parser.add_argument("--docs", type=int, help="Number of synthetic documents, default=20", default=20)
+    parser.add_argument("--size", type=int, help="Size of each document in characters, default=20000",
+                        default=20000)
+    parser.add_argument("--seed", type=int, help="Random seed for the corpus, default=0", default=0)
+    parser.add_argument("--repeat", type=int, help="Timed runs per benchmark, default=3", default=3)
+    parser.add_argument("--only", type=str, help="Comma separated benchmark names to run")
+    parser.add_argument("--concept", type=str, help="Concept for redact_concept, default=child", default='child')
+    parser.add_argument("--concepts", type=str, help="Comma separated concepts for redact_concepts, " \
+                                                     "default=child,budget,office,meeting,project",
+                        default='child,budget,office,meeting,project')
+    parser.add_argument("--workers", type=int, help="Workers for the pipeline benchmark, default=1", default=1)
+    parser.add_argument("--json", type=str, help="File the results are written to as JSON")
+    parser.add_argument("--compare", type=str, help="JSON results file from an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    only = set(args.only.split(',')) if args.only else None
+    corpusdir = tempfile.mkdtemp()
+    try:
+        counts = generate_corpus(corpusdir, args.docs, args.size, seed=args.seed)
+        documents = []
+        for f in sorted(os.listdir(corpusdir)):
+            with open(os.path.join(corpusdir, f), encoding='utf-8') as fin:
+                documents.append(fin.read())
+
+        results = dict(commit=git_commit(), python=platform.python_version(), timestamp=time.time(),
+                       docs=args.docs, size=args.size, seed=args.seed, inserted=counts, benchmarks={})
+        print("%-24s %10s %10s %10s" % ("benchmark", "docs/sec", "MB/sec", "peak MB"))
+        benchmarks = [(name, lambda func=func: measure(func, documents, args.repeat))
+                      for name, func in detector_benchmarks(args.concept, args.concepts)]
+        benchmarks.append(('pipeline_regex', lambda: measure_pipeline(
+            corpusdir, ['--phones', '--emails', '--addresses', '--dates'], args.workers, args.repeat)))
+        benchmarks.append(('pipeline_all', lambda: measure_pipeline(
+            corpusdir, ['--phones', '--emails', '--addresses', '--dates', '--names', '--genders',
+                        '--concepts', args.concept], args.workers, args.repeat)))
+        for name, run in benchmarks:
+            if only and name not in only:
+                continue
+            result = run()
+            results['benchmarks'][name] = result
+            print("%-24s %10.1f %10.3f %10.2f%s" % (name, result['docs_per_sec'], result['mb_per_sec'],
+                                                    result['peak_memory_mb'],
+                                                    " (parent process only)"
+                                                    if result.get('peak_memory_scope') == 'parent' else ""))
+    finally:
+        shutil.rmtree(corpusdir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,20 +9,269 @@ Created on Mon Mar 26 19:57:34 2018
 coding = utf-8
 """
 
-import nltk
 import argparse
+import bisect
 import re
 import sys
 import os, glob
+import pickle
+import hashlib
+import queue
+import threading
+import time
+import csv
+import json
+from collections import OrderedDict, namedtuple
 
-from nltk.corpus import wordnet
-from nltk.corpus import stopwords
-from nltk import ne_chunk
+# nltk and its corpora are imported inside the functions that use them.  Importing
+# nltk takes over a second, which runs that only use the regex detectors never need.
 
-stop = stopwords.words('english')
+# English stopwords, loaded by get_stopwords
+_stopwords = None
 
-# Note:  If we import stem.* it overrides corpus.wordnet, so we only import porter
-from nltk.stem.porter import *
+
+def get_stopwords():
+    """
+    get_stopwords
+    :return: frozenset of the nltk English stopwords
+    Loads the stopwords corpus the first time it is needed.
+    """
+    global _stopwords
+    if _stopwords is None:
+        from nltk.corpus import stopwords
+        _stopwords = frozenset(stopwords.words('english'))
+    return _stopwords
+
+
+# Pattern for the word tokens counted in the summary statistics.  It splits text
+# into words and punctuation the way the treebank tokenizer does for most text,
+# without loading nltk.
+WORD_TOKEN = re.compile(r"\w+(?:[-'./@]\w+)*|\.\.\.|[^\w\s]")
+
+
+class _NullTimer(object):
+    """Context manager that does nothing, used when profiling is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _StageTimer(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler(object):
+    """
+    Profiler
+    Records the wall time and number of calls of each stage of redaction or
+    unredaction, per file.  Code marks a stage with
+         with profiler.stage('ne_chunk'):
+    which costs one method call when profiling is off.  Stages nest, so the time of
+    a stage includes the time of the stages inside it.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.current_file = None
+        self.records = OrderedDict()
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, name)
+
+    def add(self, name, seconds, calls=1, filename=None):
+        key = (filename or self.current_file or '', name)
+        record = self.records.setdefault(key, [0, 0.0])
+        record[0] += calls
+        record[1] += seconds
+
+    def take(self):
+        """Returns the records as a list of (file, stage, calls, seconds) and clears them"""
+        rows = [(filename, name, calls, seconds) for (filename, name), (calls, seconds) in self.records.items()]
+        self.records = OrderedDict()
+        return rows
+
+    def merge(self, rows):
+        """Adds rows returned by take(), for instance from a worker process"""
+        for filename, name, calls, seconds in rows:
+            self.add(name, seconds, calls, filename)
+
+    def rows(self):
+        return [(filename, name, calls, seconds) for (filename, name), (calls, seconds) in self.records.items()]
+
+    def write(self, path):
+        """Writes the records to path, as CSV if it ends with .csv and otherwise as JSON"""
+        rows = sorted(self.rows())
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            if path.endswith('.csv'):
+                writer = csv.writer(f)
+                writer.writerow(['file', 'stage', 'calls', 'seconds'])
+                writer.writerows(rows)
+            else:
+                json.dump([dict(file=filename, stage=name, calls=calls, seconds=seconds)
+                           for filename, name, calls, seconds in rows], f, indent=2)
+
+    def hotspots(self, top=10):
+        """Returns a summary of the stages with the most total time over all files"""
+        totals = {}
+        for filename, name, calls, seconds in self.rows():
+            total = totals.setdefault(name, [0, 0.0])
+            total[0] += calls
+            total[1] += seconds
+        summary = "\nTop " + str(top) + " stages by total time (nested stages are included in their parents)\n"
+        for name, (calls, seconds) in sorted(totals.items(), key=lambda item: -item[1][1])[:top]:
+            summary += "%-24s %10.3f sec %10d calls\n" % (name, seconds, calls)
+        return summary
+
+
+# Profiler shared by the redactor and unredactor, enabled with --profile
+profiler = Profiler()
+
+# Regular expressions for the regex based detectors.  Each entry is the detector name,
+# the pattern, and the text that replaces a match.  The order of the list sets the
+# priority when two detectors match at the same position in a document.
+REGEX_DETECTORS = [
+    ('phone', r'\d{3}[-\.\s]??\d{3}[-\.\s]??\d{4}|\(\d{3}\)\s*\d{3}[-\.\s]??\d{4}|\d{3}[-\.\s]??\d{4}',
+     '<phone redacted>'),
+    ('email', r'[\w\.-]+@[\w\.-]+', '<email redacted>'),
+    ('address', r'[0-9]+ .+, .+, [A-Z]{2} [0-9]{5}', '<address redacted>'),
+    ('date', r'[0-1]?\d[- /.][0-3]?\d[- /.][1-2]?\d?\d\d'
+             r'|(?:18|19|20)\d\d[- /.][0-1]?\d[- /.][0-3]?\d'
+             r'|(?:JAN|FEB|MAR|APR|MAY|JUN|JUL|AUG|SEP|OCT|NOV|DEC|Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec'
+             r'|January|February|March|April|May|June|July|August|September|October|November|December)'
+             r'[- ][0-2]?[1-9][- ,][- ][1-2]\d\d\d',
+     '<date redacted>'),
+]
+REGEX_REPLACEMENTS = dict((name, repl) for name, pattern, repl in REGEX_DETECTORS)
+
+# Text that replaces each category of redaction.  Names are replaced by thorns
+# instead, see RedactionSpan.replacement.
+REPLACEMENTS = dict(REGEX_REPLACEMENTS, concept='<concept sentence redacted>', gender='<gender redacted>')
+
+# Redaction categories in the order they are reported, with their labels
+CATEGORIES = [('phone', "Phone numbers"), ('email', "Email addresses"), ('address', "Street addresses"),
+              ('name', "Names"), ('concept', "Concept sentences"), ('gender', "Gender identifiers"),
+              ('date', "Dates")]
+
+# Version of each detector.  Bump a detector's version when a change to it alters
+# the redacted output, so that incremental runs redact the files again.
+DETECTOR_VERSIONS = dict(phone=1, email=1, address=1, date=1, name=1, concept=1, gender=1)
+
+
+class LRUCache(object):
+    """
+    LRUCache
+    Holds at most maxsize built objects, such as compiled matchers, and drops the
+    least recently used one when it is full.  The caches keyed by request options
+    use it so that a long running process, such as the redaction service, does not
+    grow without limit.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def get(self, key, build):
+        """Returns the object kept for key, calling build() to make it on a miss"""
+        try:
+            value = self._cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = build()
+            self.misses += 1
+        self._cache[key] = value
+        self._evict()
+        return value
+
+    def resize(self, maxsize):
+        """Changes the maximum number of objects held, evicting the oldest if needed"""
+        self.maxsize = maxsize
+        self._evict()
+
+    def _evict(self):
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Compiled scanners keyed by the tuple of enabled detector names
+_scanners = {}
+
+
+def get_scanner(detectors):
+    """
+    get_scanner
+    :param detectors: iterable of regex detector names, e.g. ['phone', 'date']
+    :return: compiled regular expression
+    This function fuses the patterns of the enabled detectors into one regular
+    expression with a named group per detector, so a document can be scanned for
+    all of them in a single pass.  Compiled scanners are cached.
+    """
+    key = tuple(name for name, pattern, repl in REGEX_DETECTORS if name in detectors)
+    if key not in _scanners:
+        unknown = set(detectors) - set(REGEX_REPLACEMENTS)
+        if unknown:
+            raise ValueError("Unknown regex detectors: " + ', '.join(sorted(unknown)))
+        _scanners[key] = re.compile('|'.join('(?P<' + name + '>' + pattern + ')'
+                                             for name, pattern, repl in REGEX_DETECTORS if name in key))
+    return _scanners[key]
+
+
+def scan_regex(string, detectors):
+    """
+    scan_regex
+    :param string: text to scan
+    :param detectors: iterable of regex detector names
+    :return: list of RedactionSpan tuples
+    Scans the string once with the fused scanner and returns the non-overlapping
+    spans matched by the enabled detectors in document order.
+    """
+    if not detectors:
+        return []
+    return [RedactionSpan(m.start(), m.end(), m.lastgroup, m.end() - m.start())
+            for m in get_scanner(detectors).finditer(string)]
+
+
+def redact_regex(string, detectors):
+    """
+    redact_regex
+    :param string: text to redact
+    :param detectors: iterable of regex detector names
+    :return: (newstring, counts) where counts maps detector name to number of redactions
+    Redacts every match of the enabled detectors in a single pass over the string,
+    building the output once.
+    """
+    result = RedactionResult(string, scan_regex(string, detectors), detectors)
+    return result.redacted, result.counts()
 
 
 def find_phone_numbers(string):
@@ -41,73 +290,920 @@ def find_addresses(string):
     return r.findall(string)
 
 
-def find_names(document):
-    names = []
-    sentences = ie_preprocess(document)
-    for tagged_sentence in sentences:
-        for chunk in nltk.ne_chunk(tagged_sentence):
-            if type(chunk) == nltk.tree.Tree:
-                if chunk.label() == 'PERSON':
-                    names.append(' '.join([c[0] for c in chunk]))
-    return names
+class TermMatcher(object):
+    """
+    TermMatcher
+    Finds every occurrence of a dictionary of terms in a single pass over a string.
+    The terms are put in a trie, and the trie is written out as one regular
+    expression in which each branch point is an alternation of distinct next
+    characters.  The regex engine then walks the trie at each position of the text
+    instead of trying each term in turn, and the longest term at a position wins.
+    Terms are matched literally, so names containing regex characters are safe.
+    """
+
+    def __init__(self, terms, ignorecase=False, wholewords=False):
+        self.terms = sorted(set(term for term in terms if term))
+        self.ignorecase = ignorecase
+        self.wholewords = wholewords
+        self.regex = None
+        if self.terms:
+            trie = {}
+            for term in self.terms:
+                node = trie
+                for char in (term.lower() if ignorecase else term):
+                    node = node.setdefault(char, {})
+                node[''] = None
+            pattern = self._trie_pattern(trie)
+            if wholewords:
+                pattern = r'(?<!\w)' + pattern + r'(?!\w)'
+            self.regex = re.compile(pattern, re.IGNORECASE if ignorecase else 0)
+
+    @classmethod
+    def _trie_pattern(cls, node):
+        # Build the branches in sorted order so that the pattern is reproducible
+        branches = [re.escape(char) + cls._trie_pattern(node[char]) for char in sorted(node) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1:
+            pattern = branches[0]
+        else:
+            pattern = '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            # A term ends here, but a longer term may continue, so the rest is optional
+            if len(branches) == 1:
+                pattern = '(?:' + pattern + ')'
+            pattern += '?'
+        return pattern
+
+    def finditer(self, string):
+        """Returns an iterator of (start, end) spans of the terms found in string"""
+        if self.regex is None:
+            return iter([])
+        return ((m.start(), m.end()) for m in self.regex.finditer(string))
+
+    def subn(self, repl, string):
+        """Like re.subn, replaces every term with repl and returns (newstring, count)"""
+        if self.regex is None:
+            return string, 0
+        return self.regex.subn(repl, string)
+
+    def sub(self, repl, string):
+        """Like re.sub, replaces every term with repl"""
+        return self.subn(repl, string)[0]
+
+
+def thorns(match):
+    """Returns a string of lower case thorns the length of a regex match"""
+    return u'\xfe' * (match.end() - match.start())
+
+
+def align_tokens(tokens, text, offset=0):
+    """
+    align_tokens
+    :param tokens: list of token strings produced from text
+    :param text: the string that was tokenized
+    :param offset: character offset of text within the whole document
+    :return: list of (token, start, end) tuples
+    Finds the character offsets of each token by searching forward through the
+    text.  The treebank tokenizer rewrites double quotes as `` and '', so those
+    tokens are also matched against a plain double quote.  A token that cannot
+    be found is given a zero width span at the current position.
+    """
+    spans = []
+    point = 0
+    for token in tokens:
+        candidates = [token]
+        if token in ('``', "''"):
+            candidates.append('"')
+        best = None
+        for candidate in candidates:
+            start = text.find(candidate, point)
+            if start >= 0 and (best is None or start < best[0]):
+                best = (start, start + len(candidate))
+        if best is None:
+            spans.append((token, offset + point, offset + point))
+        else:
+            spans.append((token, offset + best[0], offset + best[1]))
+            point = best[1]
+    return spans
+
+
+class NLPResources(object):
+    """
+    NLPResources
+    The nltk sentence tokenizer, word tokenizer, POS tagger and NE chunker, each
+    built the first time it is used and then kept for the life of the process.  The
+    nltk convenience functions look up, and in some nltk versions load, their
+    models again on every call.  The redactor and unredactor call the methods of
+    the shared instance, nlp_resources, or of one that is passed to them.
+    """
+
+    def __init__(self, language='english'):
+        self.language = language
+        self._sent_tokenizer = None
+        self._word_tokenizer = None
+        self._tagger = None
+        self._chunker = None
+
+    @property
+    def sent_tokenizer(self):
+        if self._sent_tokenizer is None:
+            with profiler.stage('load_models'):
+                try:
+                    from nltk.tokenize import PunktTokenizer
+                    self._sent_tokenizer = PunktTokenizer(self.language)
+                except ImportError:
+                    import nltk.data
+                    self._sent_tokenizer = nltk.data.load('tokenizers/punkt/' + self.language + '.pickle')
+        return self._sent_tokenizer
+
+    @property
+    def word_tokenizer(self):
+        if self._word_tokenizer is None:
+            try:
+                from nltk.tokenize import NLTKWordTokenizer as WordTokenizer
+            except ImportError:
+                from nltk.tokenize import TreebankWordTokenizer as WordTokenizer
+            self._word_tokenizer = WordTokenizer()
+        return self._word_tokenizer
+
+    @property
+    def tagger(self):
+        if self._tagger is None:
+            with profiler.stage('load_models'):
+                from nltk.tag import PerceptronTagger
+                self._tagger = PerceptronTagger()
+        return self._tagger
+
+    @property
+    def chunker(self):
+        if self._chunker is None:
+            with profiler.stage('load_models'):
+                try:
+                    from nltk.chunk import ne_chunker
+                    self._chunker = ne_chunker()
+                except ImportError:
+                    import nltk.data
+                    self._chunker = nltk.data.load('chunkers/maxent_ne_chunker/english_ace_multiclass.pickle')
+        return self._chunker
+
+    def sent_tokenize(self, text):
+        """Splits text into a list of sentences, like nltk.sent_tokenize"""
+        return self.sent_tokenizer.tokenize(text)
+
+    def word_tokenize(self, sentence):
+        """Splits a sentence into a list of tokens, like nltk.word_tokenize"""
+        return self.word_tokenizer.tokenize(sentence)
+
+    def pos_tag(self, tokens):
+        """Tags a list of tokens, like nltk.pos_tag"""
+        return self.tagger.tag(tokens)
+
+    def ne_chunk(self, tagged):
+        """Chunks a tagged sentence into a tree of named entities, like nltk.ne_chunk"""
+        return self.chunker.parse(tagged)
+
+    def pos_tag_sents(self, sentences):
+        """Tags a list of token lists in one call, like nltk.pos_tag_sents"""
+        return self.tagger.tag_sents(sentences)
+
+    def ne_chunk_sents(self, tagged_sentences):
+        """Chunks a list of tagged sentences in one call, like nltk.ne_chunk_sents"""
+        return list(self.chunker.parse_sents(tagged_sentences))
+
+    def load(self, tagging=True):
+        """Builds the tokenizers, and the tagger and chunker unless tagging is False"""
+        self.sent_tokenizer
+        self.word_tokenizer
+        if tagging:
+            self.tagger
+            self.chunker
+
+
+# The models shared by everything in this process
+nlp_resources = NLPResources()
+
+
+class DocumentAnalysis(object):
+    """
+    DocumentAnalysis
+    Holds the NLP analysis of a single document.  Sentences, tokens with their
+    character offsets, POS tags and NE chunks are computed the first time they are
+    asked for and then kept, so all of the detectors and the stats code share one
+    tokenization and tagging pass over the document.
+    :param text: document text
+    :param nlp: NLPResources used for the analysis, nlp_resources by default
+    """
+
+    def __init__(self, text, nlp=None):
+        self.text = text
+        self.nlp = nlp or nlp_resources
+        self._sentence_spans = None
+        self._tokens = None
+        self._tagged = None
+        self._chunks = None
+        self._sentence_chunks = {}
+        self._word_spans = None
+
+    @property
+    def sentence_spans(self):
+        """List of (sentence, start, end) tuples for the document"""
+        if self._sentence_spans is None:
+            with profiler.stage('sent_tokenize'):
+                self._sentence_spans = align_tokens(self.nlp.sent_tokenize(self.text), self.text)
+        return self._sentence_spans
+
+    @property
+    def sentences(self):
+        """List of sentence strings"""
+        return [sent for sent, start, end in self.sentence_spans]
+
+    @property
+    def tokens(self):
+        """List of sentences, each a list of (token, start, end) tuples"""
+        if self._tokens is None:
+            sentence_spans = self.sentence_spans
+            with profiler.stage('word_tokenize'):
+                self._tokens = [align_tokens(self.nlp.word_tokenize(sent), sent, start)
+                                for sent, start, end in sentence_spans]
+        return self._tokens
+
+    @property
+    def words(self):
+        """List of sentences, each a list of token strings"""
+        return [[token for token, start, end in sent] for sent in self.tokens]
+
+    @property
+    def tagged(self):
+        """List of POS tagged sentences"""
+        if self._tagged is None:
+            words = self.words
+            with profiler.stage('pos_tag'):
+                self._tagged = self.nlp.pos_tag_sents(words)
+        return self._tagged
+
+    @property
+    def chunks(self):
+        """List of NE chunk trees, one per sentence"""
+        if self._chunks is None:
+            # Sentences chunked already, for instance by chunk_documents, are kept
+            missing = [i for i in range(len(self.tokens)) if i not in self._sentence_chunks]
+            if missing:
+                chunk_documents([self], [missing])
+            self._chunks = [self._sentence_chunks[i] for i in range(len(self.tokens))]
+        return self._chunks
+
+    def sentence_chunk(self, i):
+        """
+        sentence_chunk
+        :param i: index of a sentence
+        :return: NE chunk tree of the sentence
+        Tags and chunks only the one sentence, unless the whole document has been
+        chunked already.
+        """
+        if self._chunks is not None:
+            return self._chunks[i]
+        if i not in self._sentence_chunks:
+            if self._tagged is not None:
+                tagged = self._tagged[i]
+            else:
+                with profiler.stage('pos_tag'):
+                    tagged = self.nlp.pos_tag([token for token, start, end in self.tokens[i]])
+            with profiler.stage('ne_chunk'):
+                self._sentence_chunks[i] = self.nlp.ne_chunk(tagged)
+        return self._sentence_chunks[i]
+
+    @property
+    def word_spans(self):
+        """List of (start, end) offsets of the WORD_TOKEN tokens used for word counts"""
+        if self._word_spans is None:
+            self._word_spans = [m.span() for m in WORD_TOKEN.finditer(self.text)]
+        return self._word_spans
+
+    @property
+    def word_count(self):
+        """Number of word tokens in the document"""
+        return len(self.word_spans)
+
+    def entities(self, label='PERSON', sentences=None):
+        """
+        entities
+        :param label: NE chunk label to collect
+        :param sentences: optional list of the indexes of the sentences to chunk,
+                          by default every sentence
+        :return: list of (entity, start, end) tuples
+        Walks the NE chunks of the sentences and returns the entities with the
+        given label along with their character offsets in the document.
+        """
+        from nltk.tree import Tree
+        if sentences is None:
+            trees = zip(self.chunks, self.tokens)
+        else:
+            trees = [(self.sentence_chunk(i), self.tokens[i]) for i in sentences]
+        entities = []
+        for tree, tokens in trees:
+            i = 0
+            for chunk in tree:
+                if type(chunk) == Tree:
+                    size = len(chunk.leaves())
+                    if chunk.label() == label:
+                        entities.append((' '.join([c[0] for c in chunk.leaves()]),
+                                         tokens[i][1], tokens[i + size - 1][2]))
+                    i += size
+                else:
+                    i += 1
+        return entities
+
+
+def chunk_documents(analyses, sentences=None, nlp=None):
+    """
+    chunk_documents
+    :param analyses: list of DocumentAnalysis
+    :param sentences: optional list with, for each analysis, the indexes of the
+                      sentences to chunk, or None for every sentence
+    :param nlp: NLPResources to use, by default those of the first analysis
+    :return: none
+    Tags and NE chunks the sentences of many documents together, with one
+    pos_tag_sents and one ne_chunk_sents call for the whole batch, and keeps the
+    chunks in each analysis for entities() to use.  Sentences that have already
+    been chunked are skipped.
+    """
+    nlp = nlp or (analyses[0].nlp if analyses else nlp_resources)
+    if sentences is None:
+        sentences = [None] * len(analyses)
+    pending = []
+    for analysis, indexes in zip(analyses, sentences):
+        if analysis._chunks is not None:
+            continue
+        if indexes is None:
+            indexes = range(len(analysis.tokens))
+        pending += [(analysis, i) for i in indexes if i not in analysis._sentence_chunks]
+    if not pending:
+        return
+
+    # Sentences that a document has already tagged are not tagged again
+    untagged = [(analysis, i) for analysis, i in pending if analysis._tagged is None]
+    with profiler.stage('pos_tag'):
+        tags = nlp.pos_tag_sents([[token for token, start, end in analysis.tokens[i]]
+                                  for analysis, i in untagged])
+    tagged = dict(((id(analysis), i), sent) for (analysis, i), sent in zip(untagged, tags))
+    with profiler.stage('ne_chunk'):
+        chunks = nlp.ne_chunk_sents([analysis._tagged[i] if analysis._tagged is not None
+                                     else tagged[(id(analysis), i)] for analysis, i in pending])
+    for (analysis, i), chunk in zip(pending, chunks):
+        analysis._sentence_chunks[i] = chunk
+
+
+def is_name_candidate(token, stopwords):
+    """
+    is_name_candidate
+    :param token: word token
+    :param stopwords: set of lower case words that are not names when capitalized
+    :return: True if the token could be part of a PERSON name
+    A PERSON chunk needs a capitalized word, and capitalized stopwords (The, He, I)
+    are not names.
+    """
+    return token[:1].isupper() and token.lower() not in stopwords
+
+
+def has_name_candidate(tokens, stopwords, covered=None):
+    """
+    has_name_candidate
+    :param tokens: list of (token, start, end) tuples of a sentence
+    :param stopwords: set of lower case words that are not names when capitalized
+    :param covered: optional function of (start, end) that is true for tokens already known to be names
+    :return: True if a token of the sentence could be part of a new PERSON name
+    """
+    for token, start, end in tokens:
+        if is_name_candidate(token, stopwords) and not (covered and covered(start, end)):
+            return True
+    return False
+
+
+def _has_new_name(tokens, stopwords, covered, learnt):
+    # True if the sentence has a run of name candidate tokens, outside the covered
+    # spans, that is not one of the learnt names
+    run = []
+    for token, start, end in tokens + [('', 0, 0)]:
+        if is_name_candidate(token, stopwords) and not covered(start, end):
+            run.append(token)
+        elif run:
+            if ' '.join(run) not in learnt:
+                return True
+            run = []
+    return False
+
+
+def _covered_by(spans):
+    # Returns a function telling whether (start, end) lies inside one of the sorted,
+    # non-overlapping spans
+    starts = [start for start, end in spans]
+
+    def covered(start, end):
+        i = bisect.bisect_right(starts, start) - 1
+        return i >= 0 and spans[i][1] >= end
+    return covered
+
+
+class NameDetector(object):
+    """
+    NameDetector
+    Base class of the name detection engines chosen with --ner.  find() returns
+    the names in a document, and every occurrence of those names is redacted.  A
+    detector may be given a gazetteer of names that are always found.
+    :param names: gazetteer of names
+    """
+
+    def __init__(self, names=()):
+        self.gazetteer = TermMatcher(names, wholewords=True)
+
+    def find(self, document, analysis=None):
+        """
+        find
+        :param document: string to search
+        :param analysis: optional DocumentAnalysis of the document
+        :return: list of names
+        """
+        raise NotImplementedError
+
+    def candidates(self, document, analysis):
+        """
+        candidates
+        :param document: string to search
+        :param analysis: DocumentAnalysis of the document
+        :return: list of the indexes of the sentences find() chunks, None for every sentence
+        Lets a batch of documents be chunked together with chunk_documents before
+        find() is called on each of them.
+        """
+        return None
+
+
+class ChunkNameDetector(NameDetector):
+    """
+    ChunkNameDetector
+    The accurate engine:  every sentence is POS tagged and NE chunked by nltk and
+    the PERSON chunks are the names.
+    """
+
+    def find(self, document, analysis=None):
+        if analysis is None:
+            analysis = DocumentAnalysis(document)
+        names = [document[start:end] for start, end in self.gazetteer.finditer(document)]
+        return names + [name for name, start, end in analysis.entities('PERSON')]
+
+
+class FastNameDetector(NameDetector):
+    """
+    FastNameDetector
+    Runs the nltk chunker only on the sentences that could hold a new name.  Names
+    in the gazetteer are found by a TermMatcher, and a sentence is skipped when its
+    only capitalized words are stopwords or gazetteer names.  With learn, the
+    candidate sentences are chunked in batches that double in size, and a later
+    sentence whose runs of capitalized words are all names found in the earlier
+    batches is not chunked.  Nothing is carried from one document to the next, so
+    the names found in a document do not depend on the documents seen before it.
+    :param names: gazetteer of names
+    :param learn: skip the sentences whose candidates are names found earlier in the document
+    """
+
+    def __init__(self, names=(), learn=True):
+        NameDetector.__init__(self, names)
+        self.learn = learn
+
+    def find(self, document, analysis=None):
+        if analysis is None:
+            analysis = DocumentAnalysis(document)
+        known, candidates = self._scan(document, analysis)
+        if not self.learn:
+            names = [name for name, start, end in analysis.entities('PERSON', candidates)]
+            return [document[start:end] for start, end in known] + names
+
+        stopwords = get_stopwords()
+        covered = _covered_by(known)
+        names = []
+        learnt = set()
+        position, size = 0, 1
+        while position < len(candidates):
+            # The first sentences, where names are usually introduced, are chunked in
+            # small batches so their names are learnt early
+            batch = []
+            while position < len(candidates) and len(batch) < size:
+                i = candidates[position]
+                position += 1
+                if not learnt or _has_new_name(analysis.tokens[i], stopwords, covered, learnt):
+                    batch.append(i)
+            size *= 2
+            if not batch:
+                continue
+            chunk_documents([analysis], [batch])
+            for name, start, end in analysis.entities('PERSON', batch):
+                if name not in learnt:
+                    learnt.add(name)
+                    names.append(name)
+        return [document[start:end] for start, end in known] + names
 
+    def candidates(self, document, analysis):
+        return self._scan(document, analysis)[1]
 
-def ie_preprocess(stringin):
+    def _scan(self, document, analysis):
+        # Returns the gazetteer matches and the sentences that could hold a new name
+        with profiler.stage('gazetteer'):
+            known = list(self.gazetteer.finditer(document))
+        covered = _covered_by(known)
+        stopwords = get_stopwords()
+        with profiler.stage('name_prefilter'):
+            candidates = [i for i, tokens in enumerate(analysis.tokens)
+                          if has_name_candidate(tokens, stopwords, covered)]
+        return known, candidates
+
+
+# Name detection engines for --ner.  Another engine can be added by registering a
+# NameDetector subclass here.
+NAME_DETECTORS = OrderedDict([('fast', FastNameDetector), ('chunk', ChunkNameDetector)])
+
+# Detectors built by name_detector, keyed by (engine, gazetteer file)
+_name_detectors = LRUCache()
+
+
+def name_detector(ner='chunk', gazetteer=None):
+    """
+    name_detector
+    :param ner: name of the engine in NAME_DETECTORS
+    :param gazetteer: optional file of names, one per line, see load_terms
+    :return: NameDetector
+    Detectors are built once and kept, so the gazetteer file is read only once.
+    """
+    if ner not in NAME_DETECTORS:
+        raise ValueError("Unknown name detector " + str(ner) + ", choose from " + ', '.join(NAME_DETECTORS))
+    return _name_detectors.get((ner, gazetteer),
+                               lambda: NAME_DETECTORS[ner](load_terms(gazetteer) if gazetteer else ()))
+
+
+def find_names(document, analysis=None, detector=None):
+    """
+    find_names
+    :param document: string to search
+    :param analysis: optional DocumentAnalysis of the document
+    :param detector: optional NameDetector, by default every sentence is NE chunked
+    :return: list of names
+    Returns the PERSON entities that nltk finds in the document.
+    """
+    if detector is not None:
+        return detector.find(document, analysis)
+    if analysis is None:
+        analysis = DocumentAnalysis(document)
+    return [name for name, start, end in analysis.entities('PERSON')]
+
+
+def ie_preprocess(stringin, nlp=None):
     """
     ie_preprocess
     :param document:
+    :param nlp: NLPResources to use, nlp_resources by default
     :return: tokenized sentence list
     This function takes a string and returns a tagged and tokenized string
     back to the calling function.  It uses nltk to do the work.
     """
-    stringin = ' '.join([i for i in stringin.split() if i not in stop])
-    sentences = nltk.sent_tokenize(stringin)
-    sentences = [nltk.word_tokenize(sent) for sent in sentences]
-    sentences = [nltk.pos_tag(sent) for sent in sentences]
+    nlp = nlp or nlp_resources
+    stop = get_stopwords()
+    with profiler.stage('ie_preprocess'):
+        stringin = ' '.join([i for i in stringin.split() if i not in stop])
+        sentences = nlp.sent_tokenize(stringin)
+        sentences = [nlp.word_tokenize(sent) for sent in sentences]
+        sentences = nlp.pos_tag_sents(sentences)
     return sentences
 
 
-def find_concept(document, concept):
-    # Generate list of stemmed sentences from input document string
-    stop = stopwords.words('english')
-    stemmer = PorterStemmer()
-    sentences = nltk.sent_tokenize(document)
-    stemsentlist = []
-    for sentence in sentences:
-        words = nltk.word_tokenize(sentence)
-        synonyms = []
-        docstems = []
+class StemCache(LRUCache):
+    """
+    StemCache
+    A least recently used cache that maps a word to the set of Porter stems of its
+    WordNet synonyms.  One cache is shared by every sentence and document in the
+    process, so each word of the vocabulary is expanded and stemmed only once.  The
+    cache can be saved to and loaded from a pickle file to carry it between runs.
+    """
+
+    def __init__(self, maxsize=100000):
+        super(StemCache, self).__init__(maxsize)
+        self._stemmer = None
+
+    def synonym_stems(self, word):
+        """Returns a frozenset of the stems of the WordNet synonyms of word, uncached"""
+        from nltk.corpus import wordnet
+        if self._stemmer is None:
+            # Note:  If we import stem.* it overrides corpus.wordnet, so we only import porter
+            from nltk.stem.porter import PorterStemmer
+            self._stemmer = PorterStemmer()
+        synonyms = set()
+        with profiler.stage('wordnet.synsets'):
+            synsets = wordnet.synsets(word)
+        for syn in synsets:  # Generate synonyms
+            for l in syn.lemmas():
+                synonyms.add(l.name())
+        return frozenset(self._stemmer.stem(syn) for syn in synonyms)
+
+    def stems(self, word):
+        """Returns the cached synonym stems of word, computing them on a miss"""
+        return self.get(word, lambda: self.synonym_stems(word))
+
+    def save(self, path):
+        """Saves the cached words, least recently used first, to a pickle file"""
+        with open(path, 'wb') as f:
+            pickle.dump(list(self._cache.items()), f, pickle.HIGHEST_PROTOCOL)
+
+    def load(self, path):
+        """Adds the words saved in a pickle file to the cache"""
+        with open(path, 'rb') as f:
+            for word, stems in pickle.load(f):
+                self._cache[word] = stems
+        self._evict()
+
+
+# Synonym stem cache shared by the concept functions
+stem_cache = StemCache()
+
+
+# Marks a --concepts value as the name of a file of concepts, so that a concept word
+# is never mistaken for a file that happens to have the same name
+CONCEPT_FILE_PREFIX = '@'
+
+
+def parse_concepts(concepts):
+    """
+    parse_concepts
+    :param concepts: a concept, a comma separated list of concepts, @ followed by the
+                     name of a file of concepts with one per line (see load_terms), or a
+                     list of concepts
+    :return: list of concepts, in order and without duplicates
+    """
+    if not concepts:
+        return []
+    if isinstance(concepts, str):
+        if concepts.startswith(CONCEPT_FILE_PREFIX):
+            concepts = load_terms(concepts[len(CONCEPT_FILE_PREFIX):])
+        else:
+            concepts = concepts.split(',')
+    result = []
+    for concept in concepts:
+        concept = concept.strip()
+        if concept and concept not in result:
+            result.append(concept)
+    return result
+
+
+class ConceptIndex(object):
+    """
+    ConceptIndex
+    An inverted index from the stemmed synonyms of a list of concepts to the
+    concepts they belong to.  A sentence is checked against every concept at once
+    by looking up the stems of its words, so the cost of redacting many concepts
+    is close to the cost of one.
+    :param concepts: list of concept words
+    """
+
+    def __init__(self, concepts):
+        self.concepts = list(concepts)
+        self.index = {}
+        for concept in self.concepts:
+            for stem in stem_cache.stems(concept):
+                self.index.setdefault(stem, []).append(concept)
+        self.stems = frozenset(self.index)
+
+    def match(self, words, stopwords=()):
+        """
+        match
+        :param words: list of the words of a sentence
+        :param stopwords: words that are never matched
+        :return: set of the concepts that share a stem with one of the words
+        """
+        matched = set()
         for word in words:
-            if word not in stop:
-                for syn in wordnet.synsets(word):  # Generate synonyms for words in document
-                    for l in syn.lemmas():
-                        synonyms.append(l.name())
-                for syn in synonyms:
-                    docstems.append(stemmer.stem(syn))
-        stemsentlist.append(docstems)
-
-    # Generate list of stemmed synonyms for input concept
-    constems = []
-    synonyms = []
-    for syn in wordnet.synsets(concept):  # Generate synonyms
-        for l in syn.lemmas():
-            synonyms.append(l.name())
-    for syn in synonyms:
-        constems.append(stemmer.stem(syn))
-
-    # Check for set intersection between stemmed document sentences and
-    # concept stems.  If a match, add the original sentence to the list
-    i = 0
-    matches = []
-    for sent in stemsentlist:
-        if (set(sent) & set(constems)):
-            matches.append(sentences[i])
-        i += 1
+            if word in stopwords:
+                continue
+            stems = stem_cache.stems(word)
+            if not self.stems.isdisjoint(stems):
+                for stem in self.stems.intersection(stems):
+                    matched.update(self.index[stem])
+                if len(matched) == len(self.concepts):
+                    break
+        return matched
+
 
-    # Return list of sentences that match the concept
+# Concept indexes keyed by the tuple of their concepts, or by an @ file with its
+# modification time and size
+_concept_indexes = LRUCache()
+
+
+def concept_index(concepts):
+    """
+    concept_index
+    :param concepts: concepts in any form parse_concepts accepts, or a ConceptIndex
+    :return: ConceptIndex, built once for each list of concepts
+    A concept file is read again only when it changes.
+    """
+    if isinstance(concepts, ConceptIndex):
+        return concepts
+    if isinstance(concepts, str) and concepts.startswith(CONCEPT_FILE_PREFIX):
+        stat = os.stat(concepts[len(CONCEPT_FILE_PREFIX):])
+        return _concept_indexes.get((concepts, stat.st_mtime, stat.st_size),
+                                    lambda: concept_index(parse_concepts(concepts)))
+    concepts = tuple(parse_concepts(concepts))
+    return _concept_indexes.get(concepts, lambda: ConceptIndex(concepts))
+
+
+def find_concept_matches(document, concepts, analysis=None):
+    """
+    find_concept_matches
+    :param document: string to search
+    :param concepts: concepts in any form parse_concepts accepts, or a ConceptIndex
+    :param analysis: optional DocumentAnalysis of the document
+    :return: list of (RedactionSpan, set of concepts) for the matching sentences
+    Returns the sentences that contain a word whose stemmed synonyms share a stem
+    with the stemmed synonyms of a concept, along with the concepts each matched.
+    Stems come from stem_cache.
+    """
+    if analysis is None:
+        analysis = DocumentAnalysis(document)
+    index = concept_index(concepts)
+
+    # Check each sentence's words against the index of every concept's stems.
+    # If a match, add the offsets of the sentence to the list
+    stop = get_stopwords()
+    matches = []
+    for (sentence, start, end), words in zip(analysis.sentence_spans, analysis.words):
+        matched = index.match(words, stop)
+        if matched:
+            matches.append((RedactionSpan(start, end, 'concept', end - start), matched))
     return matches
 
 
+def find_concept_spans(document, concept, analysis=None):
+    """
+    find_concept_spans
+    :param document: string to search
+    :param concept: concept word, or several concepts in any form parse_concepts accepts
+    :param analysis: optional DocumentAnalysis of the document
+    :return: list of RedactionSpan tuples for the matching sentences
+    """
+    return [span for span, matched in find_concept_matches(document, concept, analysis)]
+
+
+def find_concept(document, concept, analysis=None):
+    """
+    find_concept
+    :param document: string to search
+    :param concept: concept word, or several concepts in any form parse_concepts accepts
+    :param analysis: optional DocumentAnalysis of the document
+    :return: list of sentences that match the concept
+    """
+    return [document[span.start:span.end] for span in find_concept_spans(document, concept, analysis)]
+
+
+def splice(string, spans, replacement):
+    """
+    splice
+    :param string: text to redact
+    :param spans: list of (start, end, ...) tuples in document order that do not overlap
+    :param replacement: text that replaces each span
+    :return: newstring
+    Replaces the spans of a string in a single pass, building the output once.
+    """
+    pieces = []
+    last = 0
+    for span in spans:
+        pieces.append(string[last:span[0]])
+        pieces.append(replacement)
+        last = span[1]
+    pieces.append(string[last:])
+    return ''.join(pieces)
+
+
+class RedactionSpan(namedtuple('RedactionSpan', ['start', 'end', 'category', 'length'])):
+    """
+    RedactionSpan
+    A piece of a document to be redacted:  its character offsets, the category of
+    detector that found it and the length of the original text.
+    """
+    __slots__ = ()
+
+    @property
+    def replacement(self):
+        if self.category == 'name':
+            return u'\xfe' * self.length
+        return REPLACEMENTS[self.category]
+
+
+# Number of word tokens in each replacement text, filled in as they are needed
+_replacement_words = {'name': 1}
+
+
+def _replacement_word_count(category):
+    if category not in _replacement_words:
+        _replacement_words[category] = len(WORD_TOKEN.findall(REPLACEMENTS[category]))
+    return _replacement_words[category]
+
+
+class RedactionResult(object):
+    """
+    RedactionResult
+    The outcome of redacting a document.  It holds the original text and the spans
+    found by the detectors, from which the redacted text, the number of redactions
+    per category and the word counts are all derived without another pass over
+    the text.  Where spans overlap, the one that starts first (or is longest, for
+    spans that start together) is kept and counted, and it is extended to the end of
+    any span it overlaps, so every character a detector found is redacted.  When
+    several concepts are redacted,
+    concepts maps each concept to the starts of the concept spans that matched it.
+    """
+
+    def __init__(self, text, spans, categories, analysis=None, concepts=None):
+        self.text = text
+        self.categories = list(categories)
+        self.analysis = analysis
+        self.concepts = concepts or OrderedDict()
+        self.spans = []
+        last = 0
+        for span in sorted(spans, key=lambda span: (span.start, -span.end)):
+            if span.start >= last:
+                self.spans.append(span)
+                last = span.end
+            elif span.end > last:
+                kept = self.spans[-1]
+                self.spans[-1] = kept._replace(end=span.end, length=span.end - kept.start)
+                last = span.end
+        self._redacted = None
+
+    @property
+    def redacted(self):
+        """The redacted text"""
+        if self._redacted is None:
+            pieces = []
+            last = 0
+            for span in self.spans:
+                pieces.append(self.text[last:span.start])
+                pieces.append(span.replacement)
+                last = span.end
+            pieces.append(self.text[last:])
+            self._redacted = ''.join(pieces)
+        return self._redacted
+
+    def counts(self):
+        """Returns a dictionary of the number of redactions for each category"""
+        counts = dict((category, 0) for category in self.categories)
+        for span in self.spans:
+            counts[span.category] = counts.get(span.category, 0) + 1
+        return counts
+
+    def concept_counts(self):
+        """Returns an OrderedDict of the number of redacted sentences that matched each concept"""
+        starts = set(span.start for span in self.spans if span.category == 'concept')
+        return OrderedDict((concept, len(starts.intersection(matched)))
+                           for concept, matched in self.concepts.items())
+
+    @property
+    def summarystats(self):
+        """
+        List of [label, count] pairs for the selected categories in report order.
+        With more than one concept, the count of each concept follows the concept
+        sentences.  A sentence that matches several concepts counts for each of them.
+        """
+        counts = self.counts()
+        stats = []
+        for category, label in CATEGORIES:
+            if category in self.categories:
+                stats.append([label, counts[category]])
+                if category == 'concept' and len(self.concepts) > 1:
+                    stats += [[label + " (" + concept + ")", count]
+                              for concept, count in self.concept_counts().items()]
+        return stats
+
+    @property
+    def initial_words(self):
+        """Number of word tokens in the original text"""
+        if self.analysis is None:
+            self.analysis = DocumentAnalysis(self.text)
+        return self.analysis.word_count
+
+    @property
+    def redacted_words(self):
+        """
+        Number of word tokens in the redacted text.  The tokens of the original text
+        that overlap a span are replaced by the tokens of the span's replacement, so
+        the redacted text does not have to be tokenized again.
+        """
+        count = self.initial_words
+        tokens = self.analysis.word_spans
+        i = 0
+        for span in self.spans:
+            while i < len(tokens) and tokens[i][1] <= span.start:
+                i += 1
+            while i < len(tokens) and tokens[i][0] < span.end:
+                count -= 1
+                i += 1
+            count += _replacement_word_count(span.category)
+        return count
+
+
 def redact_phone_numbers(string):
     """
     redact_phone_numbers
@@ -117,8 +1213,7 @@ def redact_phone_numbers(string):
     string extracted from a document.  It uses regular expressions to
     do the redaction.
     """
-    newstring = re.sub(r'(\d{3}[-\.\s]??\d{3}[-\.\s]??\d{4}|\(\d{3}\)\s*\d{3}[-\.\s]??\d{4}|\d{3}[-\.\s]??\d{4})',
-                       '<phone redacted>', string)
+    newstring, counts = redact_regex(string, ['phone'])
     return newstring
 
 
@@ -130,12 +1225,7 @@ def redact_dates(stringin):
     This function redacts dates of several different types of formats from a
     string extracted from a document.  It uses regular expressions to do the redaction.
     """
-    newstring = re.sub('[0-1]?\d[- /.][0-3]?\d[- /.][1-2]?\d?\d\d', "<date redacted>", stringin)
-    newstring = re.sub('(18|19|20)\d\d[- /.][0-1]?\d[- /.][0-3]?\d', "<date redacted>", newstring)
-    newstring = re.sub('[0-1]?d[- /.][0-3]?d[- /.][1-2]?\d?\d\d', "<date redacted>", newstring)
-    newstring = re.sub(
-        '(JAN|FEB|MAR|APR|MAY|JUN|JUL|AUG|SEP|OCT|NOV|DEC|Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December)[- ][0-2]?[1-9][- ,][- ][1-2]\d\d\d',
-        "<date redacted>", newstring)
+    newstring, counts = redact_regex(stringin, ['date'])
     return newstring
 
 
@@ -147,7 +1237,7 @@ def redact_email_addresses(string):
     This function redacts all email addresses from a string extracted from
     a document.  It uses regular expresssions to do the redaction.
     """
-    newstring = re.sub(r'[\w\.-]+@[\w\.-]+', '<email redacted>', string)
+    newstring, counts = redact_regex(string, ['email'])
     return newstring
 
 
@@ -159,240 +1249,834 @@ def redact_addresses(string):
     This function redacts standard format addresses from a string that has been
     extracted from a document. It uses regular expressions to do the redaction.
     """
-    newstring = re.sub(r'[0-9]+ .+, .+, [A-Z]{2} [0-9]{5}', '<address redacted>', string)
+    newstring, counts = redact_regex(string, ['address'])
     return newstring
 
 
-def redact_names(stringin):
+def find_name_spans(document, analysis=None, detector=None):
+    """
+    find_name_spans
+    :param document: string to search
+    :param analysis: optional DocumentAnalysis of the document
+    :param detector: optional NameDetector, see find_names
+    :return: list of RedactionSpan tuples
+    Finds the formal names in the document with nltk and returns a span for every
+    occurrence of those names.
+    """
+    matcher = TermMatcher(find_names(document, analysis, detector), wholewords=True)
+    return [RedactionSpan(start, end, 'name', end - start) for start, end in matcher.finditer(document)]
+
+
+def redact_names(stringin, analysis=None):
     """redact_names
     This function passes through a string once to identify all formal
-    names.  During a second pass, it replaces patterns that match the
-    strings with a redaction text.
-    """
-    # Pass one:  create a list of formal names using nltk and PERSON chunk
-    names = []
-    sentences = ie_preprocess(stringin)
-    for tagged_sentence in sentences:
-        for chunk in nltk.ne_chunk(tagged_sentence):
-            if type(chunk) == nltk.tree.Tree:
-                if chunk.label() == 'PERSON':
-                    names.append(' '.join([c[0] for c in chunk]))
-
-    # Pass two:  use re to replace patterns that match the names in the names list
-    newstring = stringin
-    for name in names:
-        replstr = ''
-        for i in range(0,len(name)):
-            replstr += u'\xfe'
-        newstring = re.sub(name, replstr, newstring)
-
-    # Return the redacted string
-    return newstring
+    names.  During a second pass, it replaces every occurrence of those names
+    with a string of thorns of the same length, using a TermMatcher built from
+    the names.  A DocumentAnalysis of the string may be passed in to reuse its
+    NE chunks.
+    """
+    spans = find_name_spans(stringin, analysis)
+    return RedactionResult(stringin, spans, ['name']).redacted
 
 
-def redact_concept(stringin, concept):
+def redact_concept(stringin, concept, analysis=None):
     """redact_concept
     This function takes two arguments, a string to parse and a concept to look for.
-    The function then generates a list of stemmed sentences from the string
-    and generates a list of synomyms for the words in those sentences.  It next
-    takes the input concept and similarly generates a list of stemmed synonyms.
-    The function then compares these two sets, and for any sentence with overlap,
-    adds it to a list.  Finally, the function uses re to replace the sentences with
-    redaction blocks.
-    """
-    # Generate list of stemmed sentences from input document string
-    stop = stopwords.words('english')
-    stemmer = PorterStemmer()
-    sentences = nltk.sent_tokenize(stringin)
-    stemsentlist = []
-    for sentence in sentences:
-        words = nltk.word_tokenize(sentence)
-        synonyms = []
-        docstems = []
-        for word in words:
-            if word not in stop:
-                for syn in wordnet.synsets(word):  # Generate synonyms for words in document
-                    for l in syn.lemmas():
-                        synonyms.append(l.name())
-                for syn in synonyms:
-                    docstems.append(stemmer.stem(syn))
-        stemsentlist.append(docstems)
-
-    # Generate list of stemmed synonyms for input concept
-    constems = []
-    synonyms = []
-    for syn in wordnet.synsets(concept):  # Generate synonyms
-        for l in syn.lemmas():
-            synonyms.append(l.name())
-    for syn in synonyms:
-        constems.append(stemmer.stem(syn))
-
-    # Check for set intersection between stemmed document sentences and
-    # concept stems.  If a match, add the original sentence to the list
-    i = 0
-    matches = []
-    for sent in stemsentlist:
-        if (set(sent) & set(constems)):
-            matches.append(sentences[i])
-        i += 1
+    The function finds the sentences that contain a word sharing a stemmed synonym
+    with the concept, keeping each sentence as character offsets from the sentence
+    tokenizer.  The sentences are then replaced with redaction blocks in a single
+    splice over the string.  A DocumentAnalysis of the string may be passed in to
+    reuse its sentence and word tokens.
+    """
+    spans = find_concept_spans(stringin, concept, analysis)
+    return splice(stringin, spans, '<concept sentence redacted>')
 
-    # Pass two:  use re to replace patterns that match the sentences in the matches list
-    newstring = stringin
-    for match in matches:
-        newstring = re.sub(match, '<concept sentence redacted>', newstring)
 
-    # Return the redacted string
-    return newstring
+# Gender specific nouns, pronouns and possessives redacted by redact_gender
+MALE_TERMS = ['he', 'him', 'his', 'man', 'boy', 'lad', 'bloke', 'chap', 'gentleman', 'men', 'boys',
+              'lads', 'blokes', 'chaps', 'gentlemen']
+FEMALE_TERMS = ['she', 'her', 'hers', 'woman', 'girl', 'chick', 'lady', 'women', 'girls', 'chicks',
+                'ladies']
 
+# Compiled gender matchers keyed by the custom term file they include
+_gender_matchers = LRUCache()
+
+
+def load_terms(path):
+    """
+    load_terms
+    :param path: text file with one term per line, lines starting with # are ignored
+    :return: list of terms
+    """
+    terms = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                terms.append(line)
+    return terms
+
+
+def load_gender_terms(path):
+    """
+    load_gender_terms
+    :param path: text file of gender terms, see load_terms
+    :return: list of terms
+    """
+    return load_terms(path)
 
-def redact_gender(stringin):
-    """redact_gender
-    This function redacts gender specific nouns and possessives from a string
-    by comparing patterns in the string to a list of defined words.
-    """
-    malelist = ['he', 'him', 'his', 'man', 'boy', 'lad', 'bloke', 'chap', 'gentleman', 'men', 'boys',
-                'lads', 'blokes', 'chaps', 'gentlemen']
-    femalelist = ['she', 'her', 'hers', 'woman', 'girl', 'chick', 'lady', 'women', 'girls', 'chicks',
-                  'ladies']
-    words = nltk.word_tokenize(stringin)
-    newstr = stringin
-
-    # Strip each word in stringin of possessive forms and check against gender lists
-    # then replace the word in the tokenized list
-    i = 0
-    redactlist = []
-    for word in words:
-        wordroot = word.lower()
-        wordroot = wordroot.replace("'s", "")
-        wordroot = wordroot.replace("'", "")
-        if (wordroot in malelist) or (wordroot in femalelist):
-            redactlist.append(words[i])
-            words[i] = '<gender redacted>'
-        i += 1
-
-    # Untokenize and recombine
-    matches = []
-    for word in redactlist:
-        matches.append("\s" + word + "\s")
-        matches.append("\s" + word + ",")
-        matches.append("\s" + word + "\.")
-        matches.append("\s" + word + "\?")
-        matches.append("s" + word + "\!")
-        for match in matches:
-            newstr = re.sub(match, ' <gender redacted> ', newstr)
 
+def gender_matcher(termfile=None):
+    """
+    gender_matcher
+    :param termfile: optional file of extra terms, see load_gender_terms
+    :return: TermMatcher
+    Returns a case insensitive, whole word TermMatcher for the built in gender
+    terms plus any terms in termfile.  Matchers are built once and cached.
+    """
+    def build():
+        terms = MALE_TERMS + FEMALE_TERMS
+        if termfile:
+            terms = terms + load_gender_terms(termfile)
+        return TermMatcher(terms, ignorecase=True, wholewords=True)
+    return _gender_matchers.get(termfile, build)
+
+
+def find_gender_spans(document, termfile=None):
+    """
+    find_gender_spans
+    :param document: string to search
+    :param termfile: optional file of extra terms, see load_gender_terms
+    :return: list of RedactionSpan tuples
+    """
+    return [RedactionSpan(start, end, 'gender', end - start)
+            for start, end in gender_matcher(termfile).finditer(document)]
+
+
+def redact_gender(stringin, termfile=None):
+    """redact_gender
+    This function redacts gender specific nouns and pronouns from a string.  The
+    words in MALE_TERMS and FEMALE_TERMS, plus any in termfile, are compiled into
+    a single whole word pattern, so the string is rewritten in one pass.  The
+    possessive ending of a word such as woman's is left in place.
+    """
+    newstr, count = gender_matcher(termfile).subn('<gender redacted>', stringin)
     return newstr
 
 
 def word_counter(stringin):
     """
     word_counter
-    :param stringin:
+    :param stringin: string or DocumentAnalysis
     :return: integer
-    Counts the words in the string and returns the count
+    Counts the words in the string, split with WORD_TOKEN, and returns the count.
+    When given a DocumentAnalysis the count comes from its existing tokens.
     """
-    tokens = nltk.word_tokenize(stringin)
-    return len(tokens)
+    if isinstance(stringin, DocumentAnalysis):
+        return stringin.word_count
+    return len(WORD_TOKEN.findall(stringin))
 
 
-if __name__ == '__main__':
+# Redaction options and their defaults, matching the command line flags
+REDACTION_OPTIONS = OrderedDict([('names', False), ('ner', 'chunk'), ('gazetteer', None), ('genders', False),
+                                 ('genderterms', None), ('dates', False), ('addresses', False), ('phones', False),
+                                 ('emails', False), ('concepts', None)])
+
+
+def redaction_options(**flags):
+    """
+    redaction_options
+    :param flags: redaction flags, e.g. phones=True, concepts='child,dog'
+    :return: argparse.Namespace holding every redaction option
+    Builds the options object that redact_document expects without going through
+    the command line.  Options that are not given take their command line defaults.
+    Unknown options and values of the wrong type raise ValueError.
+    """
+    unknown = set(flags) - set(REDACTION_OPTIONS)
+    if unknown:
+        raise ValueError("Unknown redaction options: " + ', '.join(sorted(unknown)))
+    options = argparse.Namespace(**REDACTION_OPTIONS)
+    for name, value in flags.items():
+        if name == 'concepts' and isinstance(value, (list, tuple)):
+            if not all(isinstance(concept, str) for concept in value):
+                raise ValueError("Redaction option concepts must be a string or a list of strings")
+            # Kept as a string so that options can be compared and hashed
+            value = ','.join(value)
+        if isinstance(REDACTION_OPTIONS[name], bool):
+            if not isinstance(value, bool):
+                raise ValueError("Redaction option " + name + " must be true or false")
+        elif value is not None and not isinstance(value, str):
+            raise ValueError("Redaction option " + name + " must be a string")
+        if name == 'ner' and value not in NAME_DETECTORS:
+            raise ValueError("Unknown name detector " + str(value) + ", choose from " + ', '.join(NAME_DETECTORS))
+        setattr(options, name, value)
+    return options
+
+
+def regex_detectors(options):
+    """
+    regex_detectors
+    :param options: parsed command line arguments
+    :return: list of the regex detector names selected by the options
+    """
+    return [name for name, flag in [('phone', options.phones), ('email', options.emails),
+                                    ('address', options.addresses), ('date', options.dates)] if flag]
+
+
+def redact_document(raw, options, analysis=None, nlp=None):
+    """
+    redact_document
+    :param raw: document text
+    :param options: parsed command line arguments, or any object with the same
+                    redaction flags (names, ner, gazetteer, genders, genderterms, dates,
+                    addresses, phones, emails, concepts)
+    :param analysis: optional DocumentAnalysis of the document
+    :param nlp: NLPResources used to analyse the document when no analysis is given,
+                nlp_resources by default
+    :return: RedactionResult
+    Runs the selected detectors over a document.
+    """
+    # Every detector reports spans of the original text.  The nltk based detectors
+    # share a single analysis of the document, which also supplies the word counts.
+    if analysis is None:
+        analysis = DocumentAnalysis(raw, nlp)
+    detectors = regex_detectors(options)
+    categories = list(detectors)
+
+    # The regex detectors (phones, emails, addresses, dates) run together in
+    # a single pass over the document
+    with profiler.stage('regex'):
+        spans = scan_regex(raw, detectors)
+    if options.names:
+        with profiler.stage('names'):
+            detector = name_detector(getattr(options, 'ner', 'chunk'), getattr(options, 'gazetteer', None))
+            spans += find_name_spans(raw, analysis, detector)
+        categories.append('name')
+    concepts = OrderedDict()
+    if options.concepts:
+        with profiler.stage('concepts'):
+            # The concepts are parsed, and an @ file read, once for the document
+            index = concept_index(options.concepts)
+            concepts = OrderedDict((concept, set()) for concept in index.concepts)
+            for span, matched in find_concept_matches(raw, index, analysis):
+                spans.append(span)
+                for concept in matched:
+                    concepts[concept].add(span.start)
+        categories.append('concept')
+    if options.genders:
+        with profiler.stage('genders'):
+            spans += find_gender_spans(raw, getattr(options, 'genderterms', None))
+        categories.append('gender')
+
+    return RedactionResult(raw, spans, categories, analysis, concepts)
+
+
+def redact_documents(texts, options, nlp=None):
+    """
+    redact_documents
+    :param texts: list of document strings
+    :param options: redaction options, see redaction_options
+    :param nlp: NLPResources to use, nlp_resources by default
+    :return: list of RedactionResult, one per document
+    Redacts a batch of documents with the same options.  For name redaction the
+    sentences of all of the documents are tagged and chunked together.  A learning
+    name detector only learns from the names of the batch after it is chunked.
+    """
+    analyses = [DocumentAnalysis(text, nlp) for text in texts]
+    if options.names and len(texts) > 1:
+        with profiler.stage('names'):
+            detector = name_detector(getattr(options, 'ner', 'chunk'), getattr(options, 'gazetteer', None))
+            chunk_documents(analyses, [detector.candidates(text, analysis)
+                                       for text, analysis in zip(texts, analyses)])
+    return [redact_document(text, options, analysis) for text, analysis in zip(texts, analyses)]
+
+
+# Places where a streamed document may be split:  line breaks and the whitespace
+# that follows the end of a sentence
+_BOUNDARY = re.compile(r'\n\s*|(?<=[.!?])\s+')
+
+
+def _window_cut(buffer, limit, detectors, overlap):
+    """
+    _window_cut
+    :return: position at which buffer can be split
+    Finds the last sentence boundary in the overlap region before limit that does
+    not fall inside a match of the regex detectors.  Without one, the buffer is cut
+    at the last space outside a match, or else at the start of the match that
+    crosses limit.
+    """
+    start = max(0, limit - overlap)
+    spans = []
+    if detectors:
+        # A match that crosses a cut may start anywhere before it, so the matches
+        # are found from the start of the buffer
+        spans = [(m.start(), m.end()) for m in get_scanner(detectors).finditer(buffer) if m.end() > start]
+
+    def inside(cut):
+        return any(s < cut < e for s, e in spans)
+
+    cuts = [m.end() for m in _BOUNDARY.finditer(buffer, start, limit)]
+    for cut in reversed(cuts):
+        if not inside(cut):
+            return cut
+    # No boundary in the overlap region, so fall back to the last space
+    cut = buffer.rfind(' ', start, limit)
+    while cut > 0:
+        if not inside(cut + 1):
+            return cut + 1
+        cut = buffer.rfind(' ', start, cut)
+    for s, e in spans:
+        if 0 < s < limit < e:
+            return s
+    return limit
+
+
+def iter_windows(fileobj, window=1000000, overlap=4096, detectors=()):
+    """
+    iter_windows
+    :param fileobj: open text file
+    :param window: number of characters read at a time
+    :param overlap: number of characters at the end of each read that are held
+                    back and carried into the next window
+    :param detectors: regex detector names whose matches must not be split
+    :return: generator of text windows
+    Reads a file in windows that end on a sentence or line boundary.  The text
+    after the boundary is carried into the next window, so a date, address or
+    sentence that straddles a read is seen whole.  At most window + overlap
+    characters are held in memory at once.
+    """
+    overlap = min(overlap, window // 2)
+    carry = ''
+    while True:
+        data = fileobj.read(window)
+        buffer = carry + data
+        if not data:
+            if buffer:
+                yield buffer
+            return
+        cut = _window_cut(buffer, len(buffer) - overlap, detectors, overlap)
+        if cut > 0:
+            yield buffer[:cut]
+        carry = buffer[cut:]
+
+
+def redact_stream(fileobj, fileOut, options, window=1000000, overlap=4096, nlp=None):
+    """
+    redact_stream
+    :param fileobj: open input file
+    :param fileOut: open output file
+    :param options: parsed command line arguments
+    :param window: number of characters read at a time
+    :param overlap: number of characters carried between windows
+    :param nlp: NLPResources to use, nlp_resources by default
+    :return: (summarystats, initial word count, redacted word count)
+    Redacts a file window by window with redact_document and writes each redacted
+    window as soon as it is done, so memory use is bounded by the window size and
+    not the size of the file.  The statistics are summed over the windows.
+    """
+    totals = []
+    initialwords = 0
+    finalwords = 0
+    for text in iter_windows(fileobj, window, overlap, regex_detectors(options)):
+        result = redact_document(text, options, nlp=nlp)
+        fileOut.write(result.redacted)
+        initialwords += result.initial_words
+        finalwords += result.redacted_words
+        if not totals:
+            totals = [[label, 0] for label, count in result.summarystats]
+        for total, (label, count) in zip(totals, result.summarystats):
+            total[1] += count
+    fileOut.write('\n')
+    return totals, initialwords, finalwords
+
+
+def _read_input(redfile):
+    """Reads a file to redact, raising IOError if it cannot be read"""
+    try:
+        with open(redfile) as f:
+            return f.read()
+    except Exception:
+        raise IOError("File read error for " + redfile)
+
+
+def _open_output(redfile, options):
+    """Opens the <name>.txt.redacted output file in the output directory (or the current directory)"""
+    outname = re.sub(options.input, "", redfile) + ".redacted"
+    try:
+        if options.output:
+            return open(os.path.join(options.output, outname), 'w', encoding='utf-8')
+        return open(outname, 'w', encoding='utf-8')
+    except Exception:
+        raise IOError("Could not open output file " + outname + ", was directory name in form of ./<name>?")
+
+
+def _file_stats(redfile, summarystats, initialwords, finalwords):
+    """Builds the statistics for a file as a string"""
+    statstring = "\n\nSummary statistics for the input file " + redfile + "\n"
+    statstring = statstring + "Initial number of words was " + str(initialwords) + "\n"
+    statstring += "Number of words in redacted file is " + str(finalwords) + "\n"
+    for tuple in summarystats:
+        statstring += tuple[0] + ":  " + str(tuple[1]) + " redactions\n"
+    return statstring
+
+
+def redact_file(redfile, options, nlp=None):
+    """
+    redact_file
+    :param redfile: path of the *.txt file to redact
+    :param options: parsed command line arguments
+    :param nlp: NLPResources to use, nlp_resources by default
+    :return: summary statistics for the file as a string
+    Reads a file, redacts it and writes the <name>.txt.redacted output file to the
+    output directory (or the current directory).  Errors are raised to the caller.
+    """
+    # Read in document to be redacted into a string, unless it is to be streamed
+    stream = getattr(options, 'stream', False)
+    if stream:
+        try:
+            os.stat(redfile)
+        except Exception:
+            raise IOError("File read error for " + redfile)
+    else:
+        with profiler.stage('read'):
+            raw = _read_input(redfile)
+
+    # Create output file
+    fileOut = _open_output(redfile, options)
+
+    try:
+        if stream:
+            # Redact and write the file a window at a time
+            with profiler.stage('redact_stream'), open(redfile) as f:
+                summarystats, initialwords, finalwords = redact_stream(f, fileOut, options, options.window,
+                                                                       nlp=nlp)
+        else:
+            with profiler.stage('redact_document'):
+                result = redact_document(raw, options, nlp=nlp)
+                summarystats = result.summarystats
+                initialwords = result.initial_words
+                finalwords = result.redacted_words
+
+            # Write redacted string to the output file
+            with profiler.stage('write'):
+                print(result.redacted, file=fileOut)
+    finally:
+        fileOut.close()
+
+    return _file_stats(redfile, summarystats, initialwords, finalwords)
+
+
+def redact_files_overlapped(redfilelist, options, prefetch=4, nlp=None):
+    """
+    redact_files_overlapped
+    :param redfilelist: list of files to redact
+    :param options: parsed command line arguments
+    :param prefetch: number of files read ahead of, and waiting to be written behind, the redaction
+    :param nlp: NLPResources to use, nlp_resources by default
+    :return: dictionary of file -> (stats, error message)
+    Redacts files in this process while a reader thread reads the next files and a
+    writer thread writes the finished ones, so file system latency overlaps with the
+    redaction instead of adding to it.  The files waiting to be redacted are redacted
+    together with redact_documents.  Both queues are bounded by prefetch, so at most
+    about 3 * prefetch documents are held in memory.
+    """
+    inputs = queue.Queue(maxsize=prefetch)
+    outputs = queue.Queue(maxsize=prefetch)
+    written = {}
+
+    def reader():
+        for redfile in redfilelist:
+            start = time.perf_counter()
+            try:
+                raw, error = _read_input(redfile), None
+            except IOError as e:
+                raw, error = None, str(e)
+            inputs.put((redfile, raw, error, time.perf_counter() - start))
+
+    def writer():
+        while True:
+            item = outputs.get()
+            if item is None:
+                return
+            redfile, text = item
+            start = time.perf_counter()
+            try:
+                with _open_output(redfile, options) as fileOut:
+                    print(text, file=fileOut)
+                error = None
+            except Exception as e:
+                error = str(e)
+            written[redfile] = (error, time.perf_counter() - start)
+
+    readthread = threading.Thread(target=reader, name="reader")
+    writethread = threading.Thread(target=writer, name="writer")
+    for thread in (readthread, writethread):
+        thread.daemon = True
+        thread.start()
+
+    # The reader and writer threads only pass their timings back, the profiler is
+    # updated from this thread
+    results = {}
+    try:
+        done = 0
+        while done < len(redfilelist):
+            # The files that have already been read are redacted as one batch
+            batch = [inputs.get()]
+            while len(batch) < prefetch and done + len(batch) < len(redfilelist):
+                try:
+                    batch.append(inputs.get_nowait())
+                except queue.Empty:
+                    break
+            done += len(batch)
+            for redfile, raw, error, seconds in batch:
+                if profiler.enabled:
+                    profiler.add('read', seconds, filename=redfile)
+                if error is not None:
+                    results[redfile] = ("", error)
+            batch = [(redfile, raw) for redfile, raw, error, seconds in batch if error is None]
+            if len(batch) > 1:
+                try:
+                    with profiler.stage('redact_documents'):
+                        redacted = redact_documents([raw for redfile, raw in batch], options, nlp)
+                except Exception:
+                    # Redact the files one at a time to find the one that fails
+                    redacted = [None] * len(batch)
+            else:
+                redacted = [None] * len(batch)
+            for (redfile, raw), result in zip(batch, redacted):
+                stats, error = "", None
+                profiler.current_file = redfile
+                try:
+                    if result is None:
+                        with profiler.stage('redact_document'):
+                            result = redact_document(raw, options, nlp=nlp)
+                    outputs.put((redfile, result.redacted))
+                    stats = _file_stats(redfile, result.summarystats, result.initial_words,
+                                        result.redacted_words)
+                except Exception as e:
+                    error = str(e)
+                profiler.current_file = None
+                results[redfile] = (stats, error)
+    finally:
+        outputs.put(None)
+        writethread.join()
+
+    for redfile, (error, seconds) in written.items():
+        if profiler.enabled:
+            profiler.add('write', seconds, filename=redfile)
+        if error is not None:
+            results[redfile] = ("", error)
+    return results
+
+
+def warm_nlp_models(options):
+    """
+    warm_nlp_models
+    :param options: parsed command line arguments
+    :return: none
+    Loads the nltk models needed by the selected detectors by running them over a
+    short sample, so the first real document does not pay for the loading.
+    """
+    if options.names or options.concepts:
+        nlp_resources.load(tagging=bool(options.names))
+        analysis = DocumentAnalysis("John Smith met the lady at the station.")
+        if options.names:
+            analysis.chunks
+            get_stopwords()
+        if options.concepts:
+            find_concept(analysis.text, options.concepts, analysis)
+
+
+# Options for the redaction worker processes, set by _init_worker
+_worker_options = None
+
+
+def _init_worker(options):
+    global _worker_options
+    _worker_options = options
+    profiler.enabled = bool(getattr(options, 'profile', None))
+    profiler.current_file = '<startup>'
+    stem_cache.resize(getattr(options, 'stemcachesize', stem_cache.maxsize))
+    stemcache = getattr(options, 'stemcache', None)
+    if options.concepts and stemcache and os.path.exists(stemcache):
+        stem_cache.load(stemcache)
+    warm_nlp_models(options)
+    profiler.current_file = None
+
+
+def _redact_file_worker(redfile):
+    """Redacts one file in a worker process and returns (file, stats, error message, profile rows)"""
+    profiler.current_file = redfile
+    try:
+        stats, error = redact_file(redfile, _worker_options), None
+    except Exception as e:
+        stats, error = "", str(e)
+    profiler.current_file = None
+    return redfile, stats, error, profiler.take()
+
+
+def file_digest(path):
+    """Returns the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def options_fingerprint(options):
+    """
+    options_fingerprint
+    :param options: parsed command line arguments
+    :return: hex digest of the options that affect the redacted output and the
+             versions of the selected detectors
+    Two runs with the same fingerprint produce the same output for the same file.
+    Options only count when the detector they belong to is selected, so that
+    changing them alone does not redact every file again.  The --genderterms,
+    --gazetteer and @ --concepts files are included by their contents.
+    """
+    def contents(path):
+        return file_digest(path) if path and os.path.isfile(path) else path
+
+    categories = regex_detectors(options)
+    fields = {}
+    if options.names:
+        categories.append('name')
+        fields['ner'] = getattr(options, 'ner', 'chunk')
+        fields['gazetteer'] = contents(getattr(options, 'gazetteer', None))
+    if options.concepts:
+        categories.append('concept')
+        concepts = options.concepts
+        if isinstance(concepts, str) and concepts.startswith(CONCEPT_FILE_PREFIX):
+            concepts = contents(concepts[len(CONCEPT_FILE_PREFIX):])
+        fields['concepts'] = concepts
+    if options.genders:
+        categories.append('gender')
+        fields['genderterms'] = contents(getattr(options, 'genderterms', None))
+
+    # Streamed files are redacted a window at a time, which can change the output
+    # near the window edges
+    if getattr(options, 'stream', False):
+        fields['window'] = getattr(options, 'window', 1000000)
+    fields['detectors'] = dict((category, DETECTOR_VERSIONS[category]) for category in categories)
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class RedactionManifest(object):
+    """
+    RedactionManifest
+    Record of the files redacted into an output directory, kept in the file
+    .redactor-manifest.json.  Each input file is stored under its name with the digest
+    of its contents, the fingerprint of the options it was redacted with and its
+    statistics, so that a later run can skip it when neither has changed.
+    :param directory: output directory, '' for the current directory
+    :param fingerprint: options_fingerprint of this run
+    """
+
+    FILENAME = '.redactor-manifest.json'
+
+    def __init__(self, directory, fingerprint):
+        self.path = os.path.join(directory or '', self.FILENAME)
+        self.directory = directory or ''
+        self.fingerprint = fingerprint
+        self.entries = {}
+        self._digests = {}
+
+    def load(self):
+        """Reads the manifest file, an unreadable or missing file leaves the manifest empty"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)['files']
+        except Exception:
+            self.entries = {}
+        return self
+
+    def save(self):
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(dict(version=1, files=self.entries), f, indent=1, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+    def unchanged(self, redfile, outname):
+        """
+        unchanged
+        :param redfile: input file
+        :param outname: name of the input file relative to the input directory
+        :return: the stored statistics if the file was redacted before with the same
+                 contents and options and its output still exists, otherwise None
+        """
+        try:
+            digest = file_digest(redfile)
+        except Exception:
+            return None
+        self._digests[redfile] = digest
+        entry = self.entries.get(outname)
+        if entry is None or entry['sha256'] != digest or entry['options'] != self.fingerprint:
+            return None
+        if not os.path.exists(os.path.join(self.directory, outname + ".redacted")):
+            return None
+        return entry['stats']
+
+    def record(self, redfile, outname, stats):
+        """Stores a file redacted in this run, using the digest taken by unchanged()"""
+        digest = self._digests.get(redfile)
+        if digest is None:
+            digest = file_digest(redfile)
+        self.entries[outname] = dict(sha256=digest, options=self.fingerprint, stats=stats)
+
+    def forget(self, outname):
+        self.entries.pop(outname, None)
+
+
+def redact_files(redfilelist, options, manifest=None):
+    """
+    redact_files
+    :param redfilelist: list of files to redact
+    :param options: parsed command line arguments, options.workers sets the number of processes
+    :param manifest: optional RedactionManifest, files it lists as unchanged are skipped
+                     (unless options.force is set) and it is updated with the files redacted
+    :return: (statstring, errors) where errors is a list of (file, message) tuples
+    Redacts a list of files, in a pool of worker processes when options.workers is
+    more than one.  Otherwise, unless options.prefetch is 0 or the files are streamed,
+    reading and writing overlap with the redaction, see redact_files_overlapped.
+    Each output file is written as soon as its file is done.  The
+    statistics are merged in the order of redfilelist so the report does not depend
+    on which worker finished first, and a file that fails is reported without
+    stopping the rest of the run.
+    """
+    # Files whose contents and options have not changed since they were last
+    # redacted keep their output and statistics
+    results = {}
+    todolist = redfilelist
+    if manifest is not None and not getattr(options, 'force', False):
+        todolist = []
+        for redfile in redfilelist:
+            stats = manifest.unchanged(redfile, re.sub(options.input, "", redfile))
+            if stats is None:
+                todolist.append(redfile)
+            else:
+                results[redfile] = (stats, None, ())
+        if len(todolist) < len(redfilelist):
+            print("Skipping " + str(len(redfilelist) - len(todolist)) + " unchanged files")
+
+    workers = getattr(options, 'workers', 1) or 1
+    if not todolist:
+        pass
+    elif workers > 1 and len(todolist) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=min(workers, len(todolist)),
+                                    initializer=_init_worker, initargs=(options,))
+        try:
+            for redfile, stats, error, rows in pool.imap_unordered(_redact_file_worker, todolist):
+                results[redfile] = (stats, error, rows)
+        finally:
+            pool.close()
+            pool.join()
+    elif getattr(options, 'prefetch', 0) > 0 and not getattr(options, 'stream', False) and len(todolist) > 1:
+        _init_worker(options)
+        for redfile, (stats, error) in redact_files_overlapped(todolist, options, options.prefetch).items():
+            results[redfile] = (stats, error, ())
+    else:
+        _init_worker(options)
+        for redfile in todolist:
+            redfile, stats, error, rows = _redact_file_worker(redfile)
+            results[redfile] = (stats, error, rows)
+
+    if manifest is not None:
+        for redfile in todolist:
+            stats, error, rows = results[redfile]
+            if error is None:
+                manifest.record(redfile, re.sub(options.input, "", redfile), stats)
+            else:
+                manifest.forget(re.sub(options.input, "", redfile))
+
+    statstring = ""
+    errors = []
+    for redfile in redfilelist:
+        stats, error, rows = results[redfile]
+        profiler.merge(rows)
+        if error is None:
+            statstring += stats
+        else:
+            errors.append((redfile, error))
+    return statstring, errors
+
+
+def run_redactor(argv=None):
+    """
+    run_redactor
+    :param argv: list of command line arguments, defaults to sys.argv
+    :return: exit status
+    Command line entry point for redactor.py
+    """
     parser = argparse.ArgumentParser()
 
     # The --input flag defaults to the current directory unless another one is specified
     parser.add_argument("--input", type=str, help="The directory of *.txt files, e.g. ./ or " \
                                                   "/<directory>/  The directory must exist.", default='./')
     parser.add_argument("--names", help="Redact formal names", action="store_true")
+    parser.add_argument("--ner", type=str, help="Name detection engine for --names:  fast skips the nltk " \
+                                                "chunker for sentences without new name candidates, chunk " \
+                                                "chunks every sentence, default=chunk", default='chunk')
+    parser.add_argument("--gazetteer", type=str, help="File of names, one per line, that --names always redacts")
     parser.add_argument("--genders", help="Redact gender identifiers", action="store_true")
     parser.add_argument("--dates", help="Redact dates", action="store_true")
     parser.add_argument("--addresses", help="Redact standard format addresses", action="store_true")
     parser.add_argument("--phones", help="Redact standard format phone numbers", action="store_true")
     parser.add_argument("--emails", help="Redact standard format emails", action="store_true")
-    parser.add_argument("--concepts", type=str, help="Redact sentences with a concept")
+    parser.add_argument("--concepts", type=str, help="Redact sentences with a concept, a comma separated " \
+                                                     "list of concepts, or @<file> for a file of concepts " \
+                                                     "one per line")
+    parser.add_argument("--genderterms", type=str, help="File of extra gender terms, one per line, " \
+                                                        "redacted along with the built in list by --genders")
     parser.add_argument("--output", type=str, help="Target directory for output files' \
                         '(must exist, enter as ./<dirname>/)")
     parser.add_argument("--stats", type=str, help="File name for stats file.  If not included " \
                                                   "the stats are printed to standard output.  File " \
                                                     " is written to the input directory.")
-    args = parser.parse_args()
+    parser.add_argument("--workers", type=int, help="Number of worker processes used to redact " \
+                                                    "files in parallel, default=1", default=1)
+    parser.add_argument("--force", help="Redact every file, even those the output directory's manifest " \
+                                        "lists as unchanged since the last run", action="store_true")
+    parser.add_argument("--prefetch", type=int, help="Number of files read ahead and written behind the " \
+                                                     "redaction on background threads, 0 turns this off, " \
+                                                     "default=4", default=4)
+    parser.add_argument("--stemcache", type=str, help="Pickle file that keeps the synonym stems used by " \
+                                                      "--concepts between runs")
+    parser.add_argument("--stemcachesize", type=int, help="Maximum number of words held in the synonym " \
+                                                          "stem cache, default=100000", default=100000)
+    parser.add_argument("--stream", help="Read, redact and write each file in windows so that " \
+                                         "memory use does not grow with the file size", action="store_true")
+    parser.add_argument("--window", type=int, help="Number of characters per window with --stream, " \
+                                                   "default=1000000", default=1000000)
+    parser.add_argument("--profile", type=str, help="File for a per file, per stage timing report, " \
+                                                    "written as CSV if the name ends in .csv and JSON otherwise")
+    parser.add_argument("--profiletop", type=int, help="Number of stages in the hotspot summary printed " \
+                                                       "with --profile, default=10", default=10)
+    args = parser.parse_args(argv)
 
     # Create a list of files to redact.
-    redfilelist = glob.glob(args.input+"*.txt")
+    redfilelist = sorted(glob.glob(args.input+"*.txt"))
     print("Redacting files: ", redfilelist)
 
-    # Initialize statistics file, which will track stats for the whole glob
-    statstring = ""
+    # Files that are unchanged since the last run into the output directory are skipped
+    manifest = RedactionManifest(args.output, options_fingerprint(args)).load()
 
     # Run the redaction routines for the files in the list
-    for redfile in redfilelist:
-        # Read in document to be redacted into a string
-        try:
-            f = open(redfile)
-            raw = f.read()
-            f.close()
-        except:
-            print("File read error, exiting...")
-            sys.exit(1)
-
-        # Create output file
-        outname = re.sub(args.input, "", redfile) + ".redacted"
+    statstring, errors = redact_files(redfilelist, args, manifest)
+    for redfile, error in errors:
+        print("Error occurred during redaction of " + redfile + ": " + error)
+    try:
+        manifest.save()
+    except Exception as e:
+        print("Could not save manifest", e.args)
 
+    # Keep the synonym stems for the next run.  Worker processes have their own
+    # caches, so the file is only updated when the files were redacted here.
+    if args.concepts and args.stemcache and len(stem_cache):
         try:
-            # Open output file
-            try:
-                if args.output:
-                    fileOut = open(os.path.join(args.output, outname), 'w', encoding='utf-8')
-                else:
-                    fileOut = open(outname, 'w', encoding='utf-8')
-            except:
-                print("Could not open output file, was directory name in form of ./<name>?  Exiting...")
-                sys.exit(1)
-
-            # Redact elements from the input string
-            newstring = raw
-            summarystats = []
-            if args.phones:
-                newstring = redact_phone_numbers(newstring)
-                phonestats = re.findall("<phone redacted>", newstring)
-                summarystats.append(["Phone numbers", len(phonestats)])
-            if args.emails:
-                newstring = redact_email_addresses(newstring)
-                emailstats = re.findall("<email redacted>", newstring)
-                summarystats.append(["Email addresses", len(emailstats)])
-            if args.addresses:
-                newstring = redact_addresses(newstring)
-                addrstats = re.findall("<address redacted>", newstring)
-                summarystats.append(["Street addresses", len(addrstats)])
-            if args.names:
-                newstring = redact_names(newstring)
-                namestats = re.findall("\xfe+", newstring)
-                summarystats.append(["Names", len(namestats)])
-            if args.concepts:
-                newstring = redact_concept(newstring, args.concepts)
-                conceptstats = re.findall("<concept sentence redacted>", newstring)
-                summarystats.append(["Concept sentences", len(conceptstats)])
-            if args.genders:
-                newstring = redact_gender(newstring)
-                genderstats = re.findall("<gender redacted>", newstring)
-                summarystats.append(["Gender identifiers", len(genderstats)])
-            if args.dates:
-                newstring = redact_dates(newstring)
-                datestats = re.findall("<date redacted>", newstring)
-                summarystats.append(["Dates", len(phonestats)])
-
-            # Write redacted string to the output file
-            print(newstring, file=fileOut)
-            fileOut.close()
-
-            # Print out statistics
-            statstring = statstring + "\n\nSummary statistics for the input file " + redfile + "\n"
-            statstring = statstring + "Initial number of words was " + str(word_counter(raw)) + "\n"
-            statstring += "Number of words in redacted file is " + str(word_counter(newstring)) + "\n"
-            for tuple in summarystats:
-                statstring += tuple[0] + ":  " + str(tuple[1]) + " redactions\n"
-
+            stem_cache.save(args.stemcache)
         except Exception as e:
-            print("Error occurred during file redaction, exiting...", e.args)
-            sys.exit(1)
+            print("Could not save stem cache", e.args)
 
     # Print out stats to either a defined file or standard out
     try:
@@ -405,4 +2089,21 @@ if __name__ == '__main__':
 
     except Exception as e:
         print("Error writing stats, exiting...", e.args)
-        sys.exit(1)
+        return 1
+
+    # Write the timing report and print the hotspots
+    if args.profile:
+        try:
+            profiler.write(args.profile)
+        except Exception as e:
+            print("Error writing profile, exiting...", e.args)
+            return 1
+        print(profiler.hotspots(args.profiletop))
+
+    if errors:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run_redactor())
@@ -0,0 +1,354 @@
+"""
+service.py
+A long running redaction service that keeps the nltk models and the unredaction
+classifier loaded between requests.  Requests are sent as JSON over HTTP, either on
+a localhost port or on a Unix socket, and take the same options as the redactor.py
+command line flags:
+
+     POST /redact     {"text": "...", "names": true, "phones": true, "concepts": ["child", "money"]}
+                      returns {"text": "...", "stats": [["Names", 1], ...],
+                               "words": [initial count, redacted count]}
+     POST /unredact   {"text": "...", "fname": "4356_10.txt.redacted"}
+                      returns {"text": "..."}
+     GET  /health     returns {"status": "ok"}
+
+Files named by the genderterms, gazetteer and @ concepts options are only accepted
+when the service is started with --datadir, and must be inside that directory.
+
+Requests are handled on concurrent threads.  Redaction requests are queued and a
+batcher groups the ones that arrive close together, with the same options, into a
+batch that is redacted in one call, on a pool of worker processes when --workers is
+more than one.  Start the service with
+
+     python3 -m redactor.service --port 8765 --pickle dtclf.pkl
+
+coding = utf-8
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from .redactor import redaction_options, redact_documents, warm_nlp_models, stem_cache, CONCEPT_FILE_PREFIX
+from .unredactor import unredact_file, load_model, get_review
+
+log = logging.getLogger("REDACTOR_SERVICE")
+log.setLevel(logging.INFO)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+
+formatter = logging.Formatter("%(asctime)s %(levelname)s:%(name)s %(message)s")
+ch.setFormatter(formatter)
+
+log.addHandler(ch)
+
+
+def _redact_batch(texts, options):
+    """Redacts a batch of texts and returns the JSON replies, run in the batcher or a worker process"""
+    return [dict(text=result.redacted, stats=result.summarystats,
+                 words=[result.initial_words, result.redacted_words])
+            for result in redact_documents(texts, options)]
+
+
+def _init_service_worker():
+    warm_nlp_models(redaction_options(names=True, concepts='warm'))
+
+
+class _PendingRequest(object):
+    """A queued redaction request that a handler thread waits on"""
+
+    def __init__(self, text, options):
+        self.text = text
+        self.options = options
+        self.done = threading.Event()
+        self.reply = None
+        self.error = None
+
+    def finish(self, reply=None, error=None):
+        self.reply = reply
+        self.error = error
+        self.done.set()
+
+
+class RedactionService(object):
+    """
+    RedactionService
+    Holds the warm models and the request batcher.  redact() and unredact() may be
+    called from any number of threads.
+    :param pickle: optional file of a pickled classifier for unredaction
+    :param workers: number of worker processes for redaction batches, 1 redacts in the batcher thread
+    :param batchsize: largest number of documents in a batch
+    :param batchwait: seconds the batcher waits for more requests after the first one arrives
+    :param warm: load the nltk models before taking requests
+    :param timeout: seconds a request waits for its redaction before it fails
+    :param datadir: directory that the term files named by requests must be in.  Without
+                    it requests cannot name files.
+    """
+
+    def __init__(self, pickle=None, workers=1, batchsize=32, batchwait=0.005, warm=True, timeout=60,
+                 datadir=None):
+        self.batchsize = batchsize
+        self.batchwait = batchwait
+        self.timeout = timeout
+        self.datadir = os.path.realpath(datadir) if datadir else None
+        self.clf = None
+        if pickle:
+            log.info("Loading classifier " + pickle)
+            self.clf = load_model(pickle)
+        self.pool = None
+        if workers > 1:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(processes=workers, initializer=_init_service_worker if warm else None)
+        elif warm:
+            log.info("Loading nltk models...")
+            _init_service_worker()
+        self._queue = queue.Queue()
+        self._batcher = threading.Thread(target=self._run_batcher, name="batcher")
+        self._batcher.daemon = True
+        self._batcher.start()
+
+    def redact(self, text, **flags):
+        """
+        redact
+        :param text: document to redact
+        :param flags: redaction options as for redaction_options
+        :return: dictionary with the redacted text, stats and word counts
+        """
+        if not isinstance(text, str):
+            raise ValueError("text must be a string")
+        request = _PendingRequest(text, redaction_options(**self._data_files(flags)))
+        self._queue.put(request)
+        if not request.done.wait(self.timeout):
+            raise TimeoutError("The redaction did not finish within " + str(self.timeout) + " seconds")
+        if request.error is not None:
+            raise request.error
+        return request.reply
+
+    def _data_files(self, flags):
+        """Checks that the files named by the flags are inside datadir and gives their full paths"""
+        flags = dict(flags)
+        for name in ('genderterms', 'gazetteer', 'concepts'):
+            value = flags.get(name)
+            if not isinstance(value, str) or not value:
+                continue
+            prefix = ''
+            if name == 'concepts':
+                if not value.startswith(CONCEPT_FILE_PREFIX):
+                    continue
+                prefix, value = CONCEPT_FILE_PREFIX, value[len(CONCEPT_FILE_PREFIX):]
+            if self.datadir is None:
+                raise ValueError("The service does not accept " + name + " files")
+            path = os.path.realpath(os.path.join(self.datadir, value))
+            if os.path.commonpath([path, self.datadir]) != self.datadir or not os.path.isfile(path):
+                raise ValueError("No " + name + " file " + value + " in the service's data directory")
+            flags[name] = prefix + path
+        return flags
+
+    def unredact(self, text, fname):
+        """
+        unredact
+        :param text: redacted document
+        :param fname: file name of the document, which carries the IMDB review value
+        :return: unredacted text
+        """
+        if self.clf is None:
+            raise ValueError("The service was started without a classifier (--pickle)")
+        if not isinstance(text, str):
+            raise ValueError("text must be a string")
+        try:
+            get_review(fname)
+        except (TypeError, IndexError, ValueError):
+            raise ValueError("fname must be an IMDB file name with the review value, e.g. 4356_10.txt.redacted")
+        return unredact_file(text, fname, self.clf)
+
+    def close(self):
+        self._queue.put(None)
+        self._batcher.join()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def _run_batcher(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+
+            # Collect the requests that arrive within batchwait of the first one
+            batch = [request]
+            deadline = time.time() + self.batchwait
+            while len(batch) < self.batchsize:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+
+            # Requests with the same options are redacted together.  A failure fails
+            # only the requests it affects, and the batcher carries on.
+            groups = {}
+            for request in batch:
+                try:
+                    key = tuple(sorted(vars(request.options).items()))
+                    groups.setdefault(key, []).append(request)
+                except Exception as e:
+                    request.finish(error=e)
+            for requests in groups.values():
+                try:
+                    self._dispatch(requests)
+                except Exception as e:
+                    log.exception("Error dispatching a batch")
+                    for request in requests:
+                        request.finish(error=e)
+
+    def _dispatch(self, requests):
+        texts = [request.text for request in requests]
+        options = requests[0].options
+
+        def finish(replies):
+            for request, reply in zip(requests, replies):
+                request.finish(reply=reply)
+
+        def fail(error):
+            if len(requests) > 1:
+                # Redact the requests one at a time so the error stays with the one that fails
+                for request in requests:
+                    self._dispatch([request])
+            else:
+                requests[0].finish(error=error)
+
+        if self.pool is not None:
+            self.pool.apply_async(_redact_batch, (texts, options), callback=finish, error_callback=fail)
+        else:
+            try:
+                replies = _redact_batch(texts, options)
+            except Exception as e:
+                fail(e)
+            else:
+                finish(replies)
+
+
+class RedactionRequestHandler(BaseHTTPRequestHandler):
+    """Handles the JSON requests for the RedactionService held by the server"""
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, dict(status='ok'))
+        else:
+            self._reply(404, dict(error="Unknown path " + self.path))
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+            text = body.pop('text')
+        except Exception as e:
+            self._reply(400, dict(error="Request must be a JSON object with a text field: " + str(e)))
+            return
+        try:
+            if self.path == '/redact':
+                self._reply(200, self.server.service.redact(text, **body))
+            elif self.path == '/unredact':
+                self._reply(200, dict(text=self.server.service.unredact(text, body.get('fname', ''))))
+            else:
+                self._reply(404, dict(error="Unknown path " + self.path))
+        except ValueError as e:
+            self._reply(400, dict(error=str(e)))
+        except TimeoutError as e:
+            self._reply(504, dict(error=str(e)))
+        except Exception as e:
+            log.exception("Error handling request")
+            self._reply(500, dict(error=str(e)))
+
+    def _reply(self, code, obj):
+        data = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        log.debug("%s %s", self.address_string(), format % args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, port=8765, socket_path=None, host='127.0.0.1'):
+    """
+    make_server
+    :param service: RedactionService
+    :param port: localhost port to listen on, 0 picks a free port
+    :param socket_path: path of a Unix socket to listen on instead of a port
+    :return: server, call serve_forever() to run it
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, RedactionRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RedactionRequestHandler)
+    server.service = service
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the redactor as a service with warm models")
+    parser.add_argument("--port", type=int, help="Localhost port to listen on, default=8765", default=8765)
+    parser.add_argument("--socket", type=str, help="Unix socket to listen on instead of a port")
+    parser.add_argument("--pickle", type=str, help="Pickled classifier used for /unredact requests")
+    parser.add_argument("--workers", type=int, help="Number of worker processes for redaction, default=1",
+                        default=1)
+    parser.add_argument("--batchsize", type=int, help="Largest number of documents redacted in one batch, " \
+                                                      "default=32", default=32)
+    parser.add_argument("--batchwait", type=float, help="Milliseconds to wait for more requests to batch, " \
+                                                        "default=5", default=5)
+    parser.add_argument("--stemcachesize", type=int, help="Maximum number of words held in the synonym " \
+                                                          "stem cache, default=100000", default=100000)
+    parser.add_argument("--timeout", type=float, help="Seconds a request waits for its redaction, " \
+                                                      "default=60", default=60)
+    parser.add_argument("--datadir", type=str, help="Directory of the term files that requests may name " \
+                                                    "with genderterms, gazetteer and @ concepts")
+    args = parser.parse_args(argv)
+
+    stem_cache.resize(args.stemcachesize)
+    service = RedactionService(args.pickle, args.workers, args.batchsize, args.batchwait / 1000.0,
+                               timeout=args.timeout, datadir=args.datadir)
+    server = make_server(service, args.port, args.socket)
+    log.info("Redaction service listening on " + (args.socket or "127.0.0.1:" + str(server.server_address[1])))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,23 +15,30 @@ coding = utf-8
 
 import glob
 import re
-from random import shuffle
-import joblib
+import json
+import pickle
+import random
 import sys
 import argparse
 import os
+import copy
+import functools
+import time
+from collections import OrderedDict
 
-from nltk import sent_tokenize
-from nltk import word_tokenize
-from nltk import pos_tag
-from nltk import ne_chunk
-from sklearn.naive_bayes import MultinomialNB
-from sklearn import tree
-from sklearn import svm
+# nltk, sklearn and joblib are imported by the functions that use them, so loading
+# a pickled classifier does not pay for importing the sklearn training modules.  The
+# nltk models are shared with the redactor through nlp_resources.
 
 import logging
 import importlib
 
+try:
+    from .redactor import profiler, nlp_resources, get_stopwords, is_name_candidate, NAME_DETECTORS
+except ImportError:
+    # Run as a script from the redactor directory
+    from redactor import profiler, nlp_resources, get_stopwords, is_name_candidate, NAME_DETECTORS
+
 importlib.reload(logging)  # To stop repeated outputs in iPython
 
 # Setup logging for program
@@ -47,190 +54,871 @@ ch.setFormatter(formatter)
 log.addHandler(ch)
 
 
-def get_entity(text):
+def get_entity(text, nlp=None):
     """
     get_entity() prints the PERSON entities within a text stream
     :param text: text stream containing PERSON entities
+    :param nlp: NLPResources to use, nlp_resources by default
     :return:  none
     """
-    for sent in sent_tokenize(text):
-        for chunk in ne_chunk(pos_tag(word_tokenize(sent))):
+    nlp = nlp or nlp_resources
+    words = [nlp.word_tokenize(sent) for sent in nlp.sent_tokenize(text)]
+    for chunks in nlp.ne_chunk_sents(nlp.pos_tag_sents(words)):
+        for chunk in chunks:
             if hasattr(chunk, 'label') and chunk.label() == 'PERSON':
                 print(chunk.label(), ' '.join(c[0] for c in chunk.leaves()))
 
 
-def extract_features(text, fname):
+def extract_features(text, fname, nlp=None, ner='chunk'):
     """
     extract_features() finds PERSON chunks and creates a feature set that includes different
     attributes.  It takes the previous two chunks (a chunk bigram) and also takes the
     length of the PERSON chunk and number of spaces within it.
     :param text: input text string, filename of text string
+    :param nlp: NLPResources to use, nlp_resources by default
+    :param ner: name detection engine, as for the redactor's --ner
     :return: list of dictionary features and list of PERSON values
     """
+    return extract_features_batch([text], [fname], nlp, ner)[0]
+
+
+def extract_features_batch(texts, fnames, nlp=None, ner='chunk'):
+    """
+    extract_features_batch() extracts the features of several texts at once.  The
+    sentences of all of the texts are POS tagged and NE chunked together, with one
+    pos_tag_sents and one ne_chunk_sents call for the batch.
+    :param texts: list of input text strings
+    :param fnames: list of the file names of the texts
+    :param nlp: NLPResources to use, nlp_resources by default
+    :param ner: name detection engine, as for the redactor's --ner.  chunk chunks every
+                sentence, fast skips the sentences whose only capitalized words are
+                stopwords.
+    :return: list of (features, labels), one per text, as returned by extract_features
+    """
+    if ner not in NAME_DETECTORS:
+        raise ValueError("Unknown name detector " + str(ner) + ", choose from " + ', '.join(NAME_DETECTORS))
     r = re.compile(r'\d*.txt', )
-    review = r.findall(fname)
-    review = re.sub(r'\.txt', '', review[0])
-    feature_list = []
-    label_list = []
-    for sent in sent_tokenize(text):
-        chunks = ne_chunk(pos_tag(word_tokenize(sent)))
+    nlp = nlp or nlp_resources
+    stopwords = get_stopwords()
+
+    # With fast, sentences without a capitalized word that is not a stopword are skipped
+    owners = []
+    candidates = []
+    for n, text in enumerate(texts):
+        with profiler.stage('sent_tokenize'):
+            sentences = nlp.sent_tokenize(text)
+        for sent in sentences:
+            with profiler.stage('word_tokenize'):
+                words = nlp.word_tokenize(sent)
+            if ner != 'fast' or any(is_name_candidate(word, stopwords) for word in words):
+                owners.append(n)
+                candidates.append(words)
+    with profiler.stage('pos_tag'):
+        tagged = nlp.pos_tag_sents(candidates)
+    with profiler.stage('ne_chunk'):
+        chunked = nlp.ne_chunk_sents(tagged)
+
+    results = [([], []) for text in texts]
+    reviews = [int(re.sub(r'\.txt', '', r.findall(fname)[0])) for fname in fnames]
+    for n, chunks in zip(owners, chunked):
+        feature_list, label_list = results[n]
         for i in range(0, len(chunks)):
             if hasattr(chunks[i], 'label') and chunks[i].label() == 'PERSON':
                 pnoun = ' '.join(c[0] for c in chunks[i].leaves())
                 features = [
-                    int(review),
+                    reviews[n],
                     len(pnoun)
                 ]
                 feature_list.append(features)
                 label_list.append(pnoun)
-    return (feature_list, label_list)
+    return results
 
 
-def setup_data(traincount, testcount):
+def load_feature_cache(path):
     """
-    setup_data() creates training and test data from the imdb dataset.  This dataset is assumed to
-    exist in the imdb folder within this project.  The routine takes in parameters that set the
-    number of files to be used for feature extraction.  Because feature extraction is a lengthy
-    process, the routine saves the feature and label sets as pickle files to the local directory.
+    load_feature_cache() reads a feature cache written by save_feature_cache
+    :param path: pickle file, which need not exist yet
+    :return: dictionary of file name -> (mtime, features, labels)
+    """
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return {}
+
+
+def save_feature_cache(cache, path):
+    """
+    save_feature_cache() writes the feature cache to a pickle file
+    :param cache: dictionary of file name -> (mtime, features, labels)
+    :param path: pickle file
+    :return: none
+    """
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def _init_feature_worker(profile):
+    # Drop any timings copied from the parent process
+    profiler.take()
+    profiler.enabled = profile
+    nlp_resources.load()
+
+
+def _extract_files_features(files, ner='chunk'):
+    """Extracts the features of a batch of IMDB files, run in a worker process"""
+    texts = []
+    for file in files:
+        profiler.current_file = file
+        with profiler.stage('read'):
+            f = open(file)
+            texts.append(f.read())
+            f.close()
+    profiler.current_file = None
+    with profiler.stage('extract_features'):
+        results = extract_features_batch(texts, files, ner=ner)
+    return results, profiler.take()
+
+
+def iter_file_features(filelist, workers=1, batchfiles=16, ner='chunk'):
+    """
+    iter_file_features() extracts the features and labels of each IMDB file in a list,
+    in a pool of worker processes when workers is more than one.  The files are
+    processed in batches, whose sentences are tagged and chunked together.
+    :param filelist: list of IMDB files
+    :param workers: number of worker processes
+    :param batchfiles: number of files in a batch
+    :param ner: name detection engine, see extract_features_batch
+    :return: generator of (file, features, labels), in the order of filelist
+    """
+    batches = [filelist[i:i + batchfiles] for i in range(0, len(filelist), batchfiles)]
+    extract = functools.partial(_extract_files_features, ner=ner)
+    if workers > 1 and len(batches) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=min(workers, len(batches)),
+                                    initializer=_init_feature_worker, initargs=(profiler.enabled,))
+        results = pool.imap(extract, batches)
+    else:
+        pool = None
+        results = map(extract, batches)
+    try:
+        counter = 0
+        for files, (features, rows) in zip(batches, results):
+            profiler.merge(rows)
+            for file, (filefeatures, filelabels) in zip(files, features):
+                if counter % 100 == 0:
+                    log.info("Evaluated file number " + str(counter) + " of " + str(len(filelist)))
+                counter += 1
+                yield file, filefeatures, filelabels
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+class FeatureStore(object):
+    """
+    FeatureStore holds the features and labels of a training or testing set as typed
+    NumPy arrays, which take 12 bytes per name instead of the hundreds taken by lists
+    of Python lists and strings.  The labels are stored as integer ids into a
+    vocabulary of names.  A store can be saved as .npy files and loaded back as
+    memory-mapped arrays.
+    :param features: int32 array of shape (names, 2) holding review and name length
+    :param labels: int32 array of label ids
+    :param vocab: list of label names, shared by stores whose ids must agree
+    """
+
+    def __init__(self, features, labels, vocab):
+        self.features = features
+        self.labels = labels
+        self.vocab = vocab
+
+    def __len__(self):
+        return len(self.labels)
+
+    def label_names(self):
+        """Returns the labels as an array of names"""
+        import numpy as np
+        return np.asarray(self.vocab, dtype=object)[self.labels]
+
+    def save(self, directory, name):
+        """Writes <name>_features.npy, <name>_labels.npy and <name>_vocab.json to the directory"""
+        import numpy as np
+        np.save(os.path.join(directory, name + '_features.npy'), self.features)
+        np.save(os.path.join(directory, name + '_labels.npy'), self.labels)
+        with open(os.path.join(directory, name + '_vocab.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.vocab, f)
+
+    @classmethod
+    def load(cls, directory, name, mmap=True):
+        """Reads a store written by save, memory-mapping the arrays unless mmap is False"""
+        import numpy as np
+        mode = 'r' if mmap else None
+        features = np.load(os.path.join(directory, name + '_features.npy'), mmap_mode=mode)
+        labels = np.load(os.path.join(directory, name + '_labels.npy'), mmap_mode=mode)
+        with open(os.path.join(directory, name + '_vocab.json'), encoding='utf-8') as f:
+            vocab = json.load(f)
+        return cls(features, labels, vocab)
+
+    @classmethod
+    def exists(cls, directory, name):
+        return all(os.path.exists(os.path.join(directory, name + suffix))
+                   for suffix in ('_features.npy', '_labels.npy', '_vocab.json'))
+
+
+def extract_file_features(filelist, workers=1, cache=None, vocab=None, ner='chunk'):
+    """
+    extract_file_features() extracts the features and labels of a list of IMDB files,
+    in a pool of worker processes when workers is more than one.  Files found in the
+    cache with an unchanged modification time are not processed again, and the
+    features of the files that are processed are added to the cache.
+    :param filelist: list of IMDB files
+    :param workers: number of worker processes
+    :param cache: optional dictionary of file name -> (mtime, features, labels).  The
+                  features extracted with a ner other than chunk are kept under
+                  (file name, ner).
+    :param vocab: optional list of label names to extend, so that the label ids of
+                  several stores agree
+    :param ner: name detection engine, see extract_features_batch
+    :return: FeatureStore of the files, in the order of filelist
+    """
+    import numpy as np
+    vocab = [] if vocab is None else vocab
+    index = dict((name, i) for i, name in enumerate(vocab))
+    mtimes = dict((file, os.path.getmtime(file)) for file in filelist)
+    arrays = {}
+
+    def key(file):
+        return file if ner == 'chunk' else (file, ner)
+
+    def add(file, features, labels):
+        # Keep each file's features as arrays as soon as they arrive
+        if cache is not None:
+            cache[key(file)] = (mtimes[file], features, labels)
+        ids = []
+        for label in labels:
+            if label not in index:
+                index[label] = len(vocab)
+                vocab.append(label)
+            ids.append(index[label])
+        arrays[file] = (np.asarray(features, dtype=np.int32).reshape(-1, 2), np.asarray(ids, dtype=np.int32))
+
+    todolist = []
+    for file in filelist:
+        if cache is not None and key(file) in cache and cache[key(file)][0] == mtimes[file]:
+            add(file, cache[key(file)][1], cache[key(file)][2])
+        elif file not in arrays:
+            todolist.append(file)
+            arrays[file] = None
+    log.info("Extracting features from " + str(len(todolist)) + " files, " +
+             str(len(filelist) - len(todolist)) + " found in the feature cache")
+
+    for file, features, labels in iter_file_features(todolist, workers, ner=ner):
+        add(file, features, labels)
+
+    features = np.concatenate([arrays[file][0] for file in filelist] or [np.zeros((0, 2), dtype=np.int32)])
+    labels = np.concatenate([arrays[file][1] for file in filelist] or [np.zeros(0, dtype=np.int32)])
+    return FeatureStore(features, labels, vocab)
+
+
+def imdb_filelists(traincount, testcount, seed=None):
+    """
+    imdb_filelists() picks the training and testing files from the imdb dataset
     :param traincount: number of training files to be used
     :param testcount:  number of test files to be used
-    :return: features and labels list for training and testing.  Saves as pickle files.
+    :param seed: optional seed for shuffling the files.  With the same seed, a larger count
+                 uses the files of a smaller count plus new ones.
+    :return: lists of training and testing files
     """
+    rng = random.Random(seed)
+
     # Collect training files into a list and randomly shuffle
     log.info("Accessing imdb files for training data...")
-    trainf1 = glob.glob("/projects/imdb/aclImdb/train/neg/*.txt")
-    trainf2 = glob.glob("/projects/imdb/aclImdb/train/pos/*.txt")
+    trainf1 = sorted(glob.glob("/projects/imdb/aclImdb/train/neg/*.txt"))
+    trainf2 = sorted(glob.glob("/projects/imdb/aclImdb/train/pos/*.txt"))
     alltrain = trainf1 + trainf2
-    shuffle(alltrain)
+    rng.shuffle(alltrain)
     log.info("Number of shuffled training files:  " + str(len(alltrain)))
     trainlist = alltrain[:traincount]
 
     # Collect testing files into a list and randomly shuffle
     log.info("Accessing imdb files for testing data...")
-    testf1 = glob.glob("/projects/imdb/aclImdb/test/neg/*.txt")
-    testf2 = glob.glob("/projects/imdb/aclImdb/test/pos/*.txt")
+    testf1 = sorted(glob.glob("/projects/imdb/aclImdb/test/neg/*.txt"))
+    testf2 = sorted(glob.glob("/projects/imdb/aclImdb/test/pos/*.txt"))
     alltest = testf1 + testf2
-    shuffle(alltest)
+    rng.shuffle(alltest)
     log.info("Number of shuffled testing files:  " + str(len(alltest)))
     testlist = alltest[:testcount]
+    return trainlist, testlist
+
+
+def setup_data(traincount, testcount, workers=1, cachefile=None, seed=None, ner='chunk'):
+    """
+    setup_data() creates training and test data from the imdb dataset.  This dataset is assumed to
+    exist in the imdb folder within this project.  The routine takes in parameters that set the
+    number of files to be used for feature extraction.  Because feature extraction is a lengthy
+    process, it runs in a pool of worker processes and the features of each file can be kept in
+    a cache file, so that a later run only processes the files it has not seen.
+    :param traincount: number of training files to be used
+    :param testcount:  number of test files to be used
+    :param workers: number of worker processes for feature extraction
+    :param cachefile: optional pickle file that keeps the features of each file between runs
+    :param seed: optional seed for shuffling the files.  With the same seed, a larger count
+                 uses the files of a smaller count plus new ones.
+    :param ner: name detection engine, see extract_features_batch
+    :return: FeatureStores for training and testing, sharing one label vocabulary
+    """
+    trainlist, testlist = imdb_filelists(traincount, testcount, seed)
+
+    cache = load_feature_cache(cachefile) if cachefile else None
 
     # Create a training set of data for the classifiers
     log.info("Extracting features and labels from training data...")
-    trainFeatures = []
-    trainLabels = []
-    counter = 0
-    for file in trainlist:
-        f = open(file)
-        raw = f.read()
-        f.close()
-        if counter % 10 == 0:
-            log.info("Evaluating training file number " + str(counter) + " of " + str(len(trainlist)))
-        newdata = extract_features(raw, file)
-        trainFeatures += newdata[0]
-        trainLabels += newdata[1]
-        counter += 1
+    train = extract_file_features(trainlist, workers, cache, ner=ner)
     log.info("Completed creation of training features and labels")
 
-    # Create a testing set of data for the classifiers
+    # Create a testing set of data for the classifiers, with the same label ids
     log.info("Extracting features and labels from testing data")
-    testFeatures = []
-    testLabels = []
-    counter = 0
-    for file in testlist:
-        f = open(file)
-        raw = f.read()
-        f.close()
-        if counter % 10 == 0:
-            log.info("Evaluating testing file number " + str(counter) + " of " + str(len(testlist)))
-        newdata = extract_features(raw, file)
-        testFeatures += newdata[0]
-        testLabels += newdata[1]
-        counter += 1
+    test = extract_file_features(testlist, workers, cache, train.vocab, ner)
     log.info("Completed creation of testing features and labels")
 
-    return trainFeatures, trainLabels, testFeatures, testLabels
+    if cachefile:
+        try:
+            save_feature_cache(cache, cachefile)
+        except Exception as e:
+            log.warning("Could not save feature cache " + str(e.args))
+
+    return train, test
+
+
+# Classifiers build_models can train, with the prefix of their keys in the returned
+# dictionary and the name printed in the report
+MODEL_CANDIDATES = OrderedDict([('bayes', ('BAYES', 'Naive Bayes')), ('tree', ('DT', 'Decision Tree')),
+                                ('svm', ('SVM', 'Linear SVM'))])
 
 
-def build_models(trainFeatures, trainLabels, testFeatures, testLabels):
+def make_model(name):
+    """
+    make_model() creates an untrained classifier
+    :param name: one of the MODEL_CANDIDATES names
+    :return: sklearn classifier
+    """
+    if name == 'bayes':
+        from sklearn.naive_bayes import MultinomialNB
+        return MultinomialNB()
+    if name == 'tree':
+        from sklearn import tree
+        return tree.DecisionTreeClassifier()
+    if name == 'svm':
+        from sklearn.svm import LinearSVC
+        return LinearSVC()
+    raise ValueError("Unknown model " + name + ", choose from " + ', '.join(MODEL_CANDIDATES))
+
+
+# Training data for _evaluate_model, set once per worker process by _init_training_worker
+_training_data = None
+
+
+def _init_training_worker(data):
+    global _training_data
+    _training_data = data
+
+
+def _evaluate_model(name, fold):
+    """Fits a model on one cross validation fold, or on all the training data when fold is None, and scores it"""
+    import numpy as np
+    trainFeatures, trainLabels, testFeatures, testLabels, splits = _training_data
+    if fold is None:
+        X, y, testX, testy = trainFeatures, trainLabels, testFeatures, testLabels
+    else:
+        train, test = splits[fold]
+        X, y, testX, testy = trainFeatures[train], trainLabels[train], trainFeatures[test], trainLabels[test]
+    clf = make_model(name)
+    start = time.perf_counter()
+    clf.fit(X, y)
+    fitted = time.perf_counter()
+    predictions = clf.predict(testX)
+    predicted = time.perf_counter()
+    return dict(name=name, fold=fold, score=float(np.mean(predictions == testy)) if len(testy) else 0.0,
+                fit_seconds=fitted - start, predict_seconds=predicted - fitted, predictions=len(testy),
+                clf=clf if fold is None else None)
+
+
+def _evaluate_model_process(data, task, conn):
+    """Runs one _evaluate_model task in its own process and sends back the result or the error"""
+    _init_training_worker(data)
+    try:
+        result = ('result', _evaluate_model(*task))
+    except Exception as e:
+        result = ('error', e)
+    conn.send(result)
+    conn.close()
+
+
+def _run_model_tasks(tasks, data, workers, budget):
+    """
+    _run_model_tasks() runs the model tasks in up to workers processes at a time.  A
+    candidate's clock starts when its first task starts, and once a candidate has run
+    for budget seconds its running tasks are terminated and the rest are skipped.
+    :return: (list of results, set of the names of the candidates that timed out)
+    """
+    import multiprocessing
+    from multiprocessing.connection import wait
+    queued = list(tasks)
+    running = {}
+    started = {}
+    results = []
+    timedout = set()
+
+    def stop(conn):
+        process, task = running.pop(conn)
+        process.terminate()
+        process.join()
+        conn.close()
+
+    try:
+        while queued or running:
+            while queued and len(running) < workers:
+                task = queued.pop(0)
+                if task[0] in timedout:
+                    continue
+                receiver, sender = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=_evaluate_model_process, args=(data, task, sender))
+                process.daemon = True
+                process.start()
+                sender.close()
+                started.setdefault(task[0], time.time())
+                running[receiver] = (process, task)
+            if not running:
+                continue
+
+            timeout = None
+            if budget is not None:
+                timeout = max(0, min(started[task[0]] + budget for process, task in running.values()) - time.time())
+            for conn in wait(list(running), timeout):
+                process, task = running[conn]
+                try:
+                    kind, value = conn.recv()
+                except EOFError:
+                    kind, value = 'error', RuntimeError("The " + task[0] + " model process exited with code " +
+                                                        str(process.exitcode))
+                stop(conn)
+                if kind == 'error':
+                    raise value
+                results.append(value)
+
+            # Candidates over budget give up their workers
+            if budget is not None:
+                now = time.time()
+                for conn, (process, task) in list(running.items()):
+                    if now >= started[task[0]] + budget:
+                        timedout.add(task[0])
+                        stop(conn)
+    finally:
+        for conn in list(running):
+            stop(conn)
+    return results, timedout
+
+
+def build_models(trainFeatures, trainLabels, testFeatures, testLabels, vocab=None, candidates=('bayes', 'tree'),
+                 folds=1, workers=1, budget=None):
     """
     build_models() takes as input test and training data and uses the scikit packages
-    to build three classifiers.  One Naive Bayes, and one Decision Tree, SVM performance was
-    too poor to include.  The routine prints out the progress and accuracy of each
-    of the models.
+    to build the candidate classifiers, by default a Naive Bayes and a Decision Tree.
+    With folds above one each candidate is also scored by k-fold cross validation of
+    the training data.  The fits run in worker processes when workers is more than one,
+    and a candidate that has not finished within budget seconds of starting is stopped
+    and dropped.  The routine prints the accuracy, fit time and prediction time of each
+    model and picks the most accurate one, by cross validation score when there is one.
     :param trainFeatures: A list of either integer or vectorized features for training
     :param trainLabels: A list of dependent variable classifications for training
     :param testFeatures: A list of either interger or vectorized features for testing
     :param testLabels: A list of dependent variable classifications for testing
+    :param vocab: list of label names when the labels are integer ids, as in a FeatureStore.
+                  The returned classifiers then predict names.
+    :param candidates: names of the models to build, from MODEL_CANDIDATES
+    :param folds: number of cross validation folds, 1 for none
+    :param workers: number of worker processes
+    :param budget: optional number of seconds each candidate is allowed, from when its
+                   first fit starts
     :return: classifiers and accuracy scores in a dictionary object
     """
-    # Run Naive Bayes classification and analyze results
-    # Train Naive Bayes classifier
-    log.info("Building Bayes classifier...")
-    bayesclf = MultinomialNB().fit(trainFeatures, trainLabels)
-    log.info("Bayes classifier complete")
-
-    # Predict results based upon Naive Bayes classifier and check accuracy
-    bayespredict = bayesclf.predict(testFeatures)
-    bayesscore = bayesclf.score(testFeatures, testLabels)
-    print("The accuracy of the Naive Bayes classifier is: " + str(bayesscore))
-
-    # Run Decision Tree classification and analyze results
-    # Train Decision Tree classifier
-    log.info("Building Decision Tree classifier...")
-    dtclf = tree.DecisionTreeClassifier().fit(trainFeatures, trainLabels)
-    log.info("Decision Tree classifier complete")
-
-    # Predict results based upon Decision Tree classifier and check accuracy
-    dtpredict = dtclf.predict(testFeatures)
-    dtscore = dtclf.score(testFeatures, testLabels)
-    print("The accuracy of the Decision Tree classifier is: " + str(dtscore))
-
-    # Select best model
-    if bayesscore > dtscore:
-        bestmodel = bayesclf
+    import numpy as np
+    for name in candidates:
+        make_model(name)
+    trainFeatures, trainLabels = np.asarray(trainFeatures), np.asarray(trainLabels)
+    testFeatures, testLabels = np.asarray(testFeatures), np.asarray(testLabels)
+    splits = []
+    if folds > 1:
+        from sklearn.model_selection import KFold
+        splits = list(KFold(folds, shuffle=True, random_state=0).split(trainFeatures))
+
+    # Each candidate is fitted once per fold and once on all the training data
+    tasks = [(name, fold) for name in candidates for fold in list(range(len(splits))) + [None]]
+    data = (trainFeatures, trainLabels, testFeatures, testLabels, splits)
+    results = []
+    timedout = set()
+    log.info("Building " + ', '.join(candidates) + " classifiers...")
+    if workers > 1 or budget:
+        results, timedout = _run_model_tasks(tasks, data, max(1, workers), budget)
     else:
-        bestmodel = dtclf
+        _init_training_worker(data)
+        for task in tasks:
+            results.append(_evaluate_model(*task))
+    _init_training_worker(None)
+
+    # Report each model and select the best
+    models = dict()
+    report = ["%-14s %10s %10s %12s %16s" % ("model", "accuracy", "cv", "fit sec", "predict us/name")]
+    best = None
+    for name in candidates:
+        key, label = MODEL_CANDIDATES[name]
+        if name in timedout:
+            print("The " + label + " classifier did not finish within " + str(budget) + " seconds")
+            continue
+        final = [r for r in results if r['name'] == name and r['fold'] is None][0]
+        cvscores = [r['score'] for r in results if r['name'] == name and r['fold'] is not None]
+        cvscore = float(np.mean(cvscores)) if cvscores else None
+        predict_us = final['predict_seconds'] / max(1, final['predictions']) * 1e6
+        print("The accuracy of the " + label + " classifier is: " + str(final['score']))
+        report.append("%-14s %10.5f %10s %12.3f %16.2f" % (name, final['score'],
+                                                           '-' if cvscore is None else "%.5f" % cvscore,
+                                                           final['fit_seconds'], predict_us))
+        clf = final['clf']
+
+        # Classifiers trained on label ids are given the names of their classes, so
+        # that they predict names
+        if vocab is not None:
+            clf.classes_ = np.asarray(vocab, dtype=object)[clf.classes_]
+
+        models[key + 'CLF'] = clf
+        models[key + 'SCORE'] = final['score']
+        models[key + 'CVSCORE'] = cvscore
+        models[key + 'TIMING'] = dict(fit_seconds=final['fit_seconds'], predict_us=predict_us)
+        selection = final['score'] if cvscore is None else cvscore
+        if best is None or selection >= best[1]:
+            best = (name, selection)
+    print('\n'.join(report))
+    if best is None:
+        raise RuntimeError("No model finished within " + str(budget) + " seconds")
 
     # Return the classifiers and accuracy scores in a dictionary object, including the
     # best model choice
-    return dict(BAYESCLF=bayesclf, BAYESSCORE=bayesscore, DTCLF=dtclf, DTSCORE=dtscore, BESTMODEL=bestmodel)
+    key = MODEL_CANDIDATES[best[0]][0]
+    models.update(BESTMODEL=models[key + 'CLF'], BESTNAME=best[0], BESTSCORE=models[key + 'SCORE'])
+    return models
 
 
-def unredact_file(text, fname, clf):
+def _filelist_digest(filelist):
+    import hashlib
+    return hashlib.sha1('\n'.join(filelist).encode('utf-8')).hexdigest()
+
+
+# Most rows x classes cells in one partial_fit or predict call.  MultinomialNB builds
+# dense matrices of that shape for the labels and the class scores, so this keeps each
+# call to a few tens of MB however many names the classifier knows.
+STREAMING_MAX_CELLS = 2 ** 22
+
+
+def streaming_rows(classes, batchsize=None):
     """
-    unredact_file() takes an IMDB file with a redacted names (as lower case
-    thorns) and replaces the redactions with predictions made by the
-    classifier sent to the routine
-    :param text: input text string
-    :param fname: filename of text string
-    :param clf: classifier
-    :return: unredacted text stream
+    streaming_rows() gives the number of rows passed to each partial_fit or predict
+    call of a classifier, so that rows x classes stays within STREAMING_MAX_CELLS
+    :param classes: number of classes of the classifier
+    :param batchsize: optional largest number of rows
+    :return: number of rows
+    """
+    rows = max(1, STREAMING_MAX_CELLS // max(1, classes))
+    return rows if batchsize is None else max(1, min(rows, batchsize))
+
+
+def predict_rows(clf, features):
+    """
+    predict_rows() predicts the classes of features a few rows at a time, see streaming_rows
+    :param clf: fitted classifier
+    :param features: 2D array of features
+    :return: array of predictions
+    """
+    import numpy as np
+    classes = getattr(clf, 'classes_', ())
+    rows = streaming_rows(len(classes))
+    if len(features) <= rows:
+        return clf.predict(features)
+    return np.concatenate([clf.predict(features[i:i + rows]) for i in range(0, len(features), rows)])
+
+
+def train_streaming(trainlist, testlist, workers=1, batchsize=10000, maxnames=100000, checkpoint=None,
+                    checkpointevery=10, ner='chunk'):
+    """
+    train_streaming() trains a Naive Bayes classifier with partial_fit on batches of
+    features as they are extracted from the training files, so that memory use does
+    not grow with the number of files.  The Decision Tree cannot be trained this way.
+    The model is saved to the checkpoint file every checkpointevery batches, and a run
+    over the same file list resumes from the files the checkpoint has seen.
+    :param trainlist: list of training files
+    :param testlist: list of testing files, scored a batch at a time
+    :param workers: number of worker processes for feature extraction
+    :param batchsize: number of names collected before they are fitted.  Each batch is
+                      passed to partial_fit in pieces of streaming_rows(maxnames) rows,
+                      so memory use stays flat as maxnames grows.
+    :param maxnames: most distinct names the classifier can learn.  partial_fit must be
+                     told every class up front, so the classes are the ids 0..maxnames-1
+                     and ids that are never seen are never predicted.
+    :param checkpoint: optional file for checkpoints of the model
+    :param checkpointevery: number of batches between checkpoints
+    :param ner: name detection engine, see extract_features_batch
+    :return: ModelArtifact
+    """
+    import numpy as np
+    from sklearn.naive_bayes import MultinomialNB
+
+    # Resume from a checkpoint of the same training files
+    digest = _filelist_digest(trainlist)
+    clf, vocab, start = MultinomialNB(), [], 0
+    if checkpoint and os.path.exists(checkpoint):
+        model = ModelArtifact.load(checkpoint, mmap=False)
+        if model.metadata.get('trainfiles') == digest and len(model.classifier.classes_) == maxnames \
+                and model.metadata.get('ner', 'chunk') == ner:
+            clf, vocab, start = model.classifier, list(model.vocab), model.metadata['filesdone']
+            log.info("Resuming from checkpoint after " + str(start) + " files")
+        else:
+            log.info("Checkpoint " + checkpoint + " is for other training files, starting over")
+    index = dict((name, i) for i, name in enumerate(vocab))
+    classes = np.arange(maxnames, dtype=np.int32)
+
+    rows = streaming_rows(maxnames, batchsize)
+
+    def fit_batch():
+        X, y = np.asarray(features, dtype=np.int32), np.asarray(labels, dtype=np.int32)
+        with profiler.stage('partial_fit'):
+            for i in range(0, len(y), rows):
+                clf.partial_fit(X[i:i + rows], y[i:i + rows], classes=classes)
+
+    def save(filesdone):
+        ModelArtifact(clf, vocab, metadata=dict(model='MultinomialNB', streaming=True, trainfiles=digest,
+                                                filesdone=filesdone, ner=ner)).save(checkpoint)
+
+    # Names that have never been seen have a zero prior, whose log is -inf
+    features, labels = [], []
+    batches = 0
+    filesdone = start
+    with np.errstate(divide='ignore'):
+        for file, filefeatures, filelabels in iter_file_features(trainlist[start:], workers, ner=ner):
+            for label in filelabels:
+                if label not in index:
+                    if len(vocab) == maxnames:
+                        raise ValueError("The training files have more than " + str(maxnames) +
+                                         " names, increase --maxnames")
+                    index[label] = len(vocab)
+                    vocab.append(label)
+                labels.append(index[label])
+            features += filefeatures
+            filesdone += 1
+            if len(labels) >= batchsize:
+                fit_batch()
+                features, labels = [], []
+                batches += 1
+                if checkpoint and batches % checkpointevery == 0:
+                    save(filesdone)
+        if labels:
+            fit_batch()
+    if checkpoint:
+        save(filesdone)
+    log.info("Naive Bayes classifier trained on " + str(len(vocab)) + " names")
+
+    # Score the classifier on the testing files a batch at a time.  Names that were
+    # not in the training files cannot be predicted and count as wrong.
+    correct = total = 0
+    features, labels = [], []
+
+    def score_batch():
+        predictions = predict_rows(clf, np.asarray(features, dtype=np.int32))
+        return int((predictions == np.asarray(labels)).sum()), len(labels)
+
+    for file, filefeatures, filelabels in iter_file_features(testlist, workers, ner=ner):
+        features += filefeatures
+        labels += [index.get(label, -1) for label in filelabels]
+        if len(labels) >= batchsize:
+            correct, total = [a + b for a, b in zip((correct, total), score_batch())]
+            features, labels = [], []
+    if labels:
+        correct, total = [a + b for a, b in zip((correct, total), score_batch())]
+    score = float(correct) / total if total else 0.0
+    print("The accuracy of the streamed Naive Bayes classifier is: " + str(score))
+
+    return ModelArtifact(clf, vocab, metadata=dict(model='MultinomialNB', streaming=True, trainfiles=digest,
+                                                   filesdone=filesdone, trainnames=len(vocab), score=score, ner=ner))
+
+
+# Version of the model artifact format written by ModelArtifact.save
+MODEL_FORMAT_VERSION = 1
+
+# The features the classifiers are trained on, in column order
+FEATURE_SCHEMA = ['review', 'name_length']
+
+
+class ModelArtifact(object):
+    """
+    ModelArtifact bundles a classifier with its label vocabulary, feature schema and
+    training metadata.  It is saved as a single joblib file that loads with the
+    classifier's arrays memory-mapped, and it predicts names like the classifier it
+    holds, so it can be passed anywhere a classifier is expected.
+    :param classifier: fitted sklearn classifier
+    :param vocab: optional list of names when the classifier predicts integer ids
+    :param schema: list of feature names, FEATURE_SCHEMA by default
+    :param metadata: dictionary of training information, e.g. counts and scores
+    """
+
+    def __init__(self, classifier, vocab=None, schema=None, metadata=None):
+        self.classifier = classifier
+        self.vocab = vocab
+        self.schema = list(schema or FEATURE_SCHEMA)
+        self.metadata = dict(metadata or {})
+
+    def predict(self, features):
+        predictions = predict_rows(self.classifier, features)
+        if self.vocab is None:
+            return predictions
+        import numpy as np
+        return np.asarray(self.vocab, dtype=object)[predictions]
+
+    def save(self, path):
+        """
+        save() writes the artifact.  A classifier that predicts names is stored with
+        integer classes and the names in the vocabulary, so that none of its arrays
+        hold Python objects and all of them can be memory-mapped when loaded.
+        :param path: file name of the artifact
+        :return: none
+        """
+        import joblib
+        import numpy as np
+        classifier = self.classifier
+        vocab = self.vocab
+        classes = getattr(classifier, 'classes_', None)
+        if vocab is None and classes is not None and classes.dtype == object:
+            vocab = list(classes)
+            classifier = copy.copy(classifier)
+            classifier.classes_ = np.arange(len(vocab), dtype=np.int32)
+        metadata = dict(self.metadata, saved=time.strftime('%Y-%m-%d %H:%M:%S'))
+        joblib.dump(dict(format_version=MODEL_FORMAT_VERSION, classifier=classifier, vocab=vocab,
+                         schema=self.schema, metadata=metadata), path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        load() reads an artifact written by save, or a plain pickled classifier as
+        written by earlier versions of the unredactor
+        :param path: file name of the artifact
+        :param mmap: memory-map the classifier's arrays
+        :return: ModelArtifact
+        """
+        import joblib
+        obj = joblib.load(path, mmap_mode='r' if mmap else None)
+        if not isinstance(obj, dict):
+            return cls(obj, metadata=dict(format_version=0))
+        if obj.get('format_version', 0) > MODEL_FORMAT_VERSION:
+            raise ValueError("Model " + path + " has format version " + str(obj['format_version']) +
+                             ", this unredactor reads versions up to " + str(MODEL_FORMAT_VERSION))
+        return cls(obj['classifier'], obj['vocab'], obj['schema'],
+                   dict(obj['metadata'], format_version=obj['format_version']))
+
+
+# Models loaded by load_model, keyed by file name
+_models = {}
+
+
+def load_model(path, mmap=True):
+    """
+    load_model() returns the model artifact in a file, loading it only the first time
+    it is asked for.  A file that has changed since it was loaded is loaded again.
+    :param path: file name of a model artifact or pickled classifier
+    :param mmap: memory-map the classifier's arrays
+    :return: ModelArtifact
+    """
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    cached = _models.get(key)
+    if cached is not None and cached[0] == (stat.st_mtime, stat.st_size):
+        return cached[1]
+    with profiler.stage('load_model'):
+        model = ModelArtifact.load(path, mmap)
+    _models[key] = ((stat.st_mtime, stat.st_size), model)
+    return model
+
+
+# A redacted name is a run of thorns as long as the name
+REDACTED = re.compile(u'\xfe+')
+
+
+def get_review(fname):
+    """
+    get_review() extracts the review value from an IMDB file name
+    :param fname: filename, e.g. 4356_10.txt.redacted
+    :return: review value as an integer
     """
-    # Extract review value from filename
     r = re.compile(r'\d*.txt', )
     review = r.findall(fname)
-    review = re.sub(r'\.txt', '', review[0])
+    return int(re.sub(r'\.txt', '', review[0]))
+
 
-    # Build list of redacted names
+def unredact_texts(texts, fnames, clf):
+    """
+    unredact_texts() replaces the redacted names in a batch of IMDB files with
+    predictions made by the classifier.  The features of every redaction in the batch
+    are collected in one matrix and predicted in a single call, which avoids paying
+    the classifier's per call overhead for each name.
+    :param texts: list of input text strings
+    :param fnames: list of the filenames of the text strings
+    :param clf: classifier, ModelArtifact, or file name of a model loaded with load_model
+    :return: list of unredacted text strings
+    """
+    import numpy as np
+    if isinstance(clf, str):
+        clf = load_model(clf)
+
+    # Find the redactions in every text
     log.info("Identifying redacted words...")
-    redactlist = []
-    for sent in sent_tokenize(text):
-        for word in word_tokenize(sent):
-            if u'\xfe' in word:
-                redactlist.append(word)
-
-    # Determine replacements for redacted words a store in tuples
-    replacelist = []
+    with profiler.stage('find_redactions'):
+        redactions = [[(m.start(), m.end()) for m in REDACTED.finditer(text)] for text in texts]
+        features = [[get_review(fname), end - start]
+                    for fname, spans in zip(fnames, redactions) for start, end in spans]
+    if not features:
+        return list(texts)
+
+    # Predict each distinct feature row once
     log.info("Generating predictions...")
-    for word in redactlist:
-        predict = clf.predict([[review, len(word)]])
-        replacelist.append([word, predict[0]])
+    with profiler.stage('clf.predict'):
+        rows, inverse = np.unique(np.array(features, dtype=np.int64), axis=0, return_inverse=True)
+        predictions = clf.predict(rows)[inverse.reshape(-1)]
+
+    # Splice the predictions into the texts
+    newtexts = []
+    k = 0
+    for text, spans in zip(texts, redactions):
+        pieces = []
+        last = 0
+        for start, end in spans:
+            pieces.append(text[last:start])
+            pieces.append(str(predictions[k]))
+            last = end
+            k += 1
+        pieces.append(text[last:])
+        newtexts.append(''.join(pieces))
+    return newtexts
 
-    # Replace thorns in string with replacement value
-    newtext = text
-    for tuple in replacelist:
-        newtext = re.sub(tuple[0], tuple[1], newtext)
 
+def unredact_file(text, fname, clf):
+    """
+    unredact_file() takes an IMDB file with a redacted names (as lower case
+    thorns) and replaces the redactions with predictions made by the
+    classifier sent to the routine
+    :param text: input text string
+    :param fname: filename of text string
+    :param clf: classifier, ModelArtifact, or file name of a model loaded with load_model
+    :return: unredacted text stream
+    """
+    newtext = unredact_texts([text], [fname], clf)[0]
     log.info("Returning redacted string...")
     return newtext
 
@@ -246,11 +934,50 @@ if __name__ == '__main__':
     parser.add_argument("--pickle", type=str, help="Name of optional pickle file containing pre-built classifier")
     parser.add_argument("--output", type=str, help="Target directory for output files' \
                         '(must exist, enter as ./<dirname>/)")
+    parser.add_argument("--savemodel", type=str, help="File the classifier built from the IMDB files is " \
+                                                      "saved to, for use with --pickle")
     parser.add_argument("--traincount", type=int, help="Integer value for number of " \
                                                        "training files, default=1000", default=1000)
     parser.add_argument("--testcount", type=int, help="Integer value for number of " \
                                                       "testing files, default=1000", default=1000)
+    parser.add_argument("--workers", type=int, help="Number of worker processes for feature " \
+                                                    "extraction and model building, default=1", default=1)
+    parser.add_argument("--ner", type=str, help="Name detection engine for the training features:  fast " \
+                                                "skips the nltk chunker for sentences whose only capitalized " \
+                                                "words are stopwords, chunk chunks every sentence, " \
+                                                "default=chunk", choices=list(NAME_DETECTORS), default='chunk')
+    parser.add_argument("--featurecache", type=str, help="Pickle file that keeps the features of each " \
+                                                         "IMDB file between runs")
+    parser.add_argument("--featurestore", type=str, help="Directory of .npy files holding the training " \
+                                                         "and testing features.  They are written if missing " \
+                                                         "and otherwise loaded instead of reading the IMDB files")
+    parser.add_argument("--seed", type=int, help="Seed for shuffling the IMDB files, so that runs use " \
+                                                 "the same files")
+    parser.add_argument("--models", type=str, help="Comma separated classifiers to build and choose from: " \
+                                                   "bayes, tree, svm, default=bayes,tree", default='bayes,tree')
+    parser.add_argument("--folds", type=int, help="Number of cross validation folds used to choose the " \
+                                                  "classifier, 1 for none, default=3", default=3)
+    parser.add_argument("--budget", type=float, help="Seconds each classifier may take to build before " \
+                                                     "it is dropped")
+    parser.add_argument("--streaming", help="Train a Naive Bayes classifier incrementally on batches of " \
+                                            "features as they are extracted, so memory use stays flat",
+                        action="store_true")
+    parser.add_argument("--trainbatch", type=int, help="Number of names per training batch with --streaming, " \
+                                                       "default=10000", default=10000)
+    parser.add_argument("--maxnames", type=int, help="Most distinct names learnt with --streaming, " \
+                                                     "default=100000", default=100000)
+    parser.add_argument("--checkpoint", type=str, help="Model file checkpointed during --streaming training, " \
+                                                       "a later run with the same files resumes from it")
+    parser.add_argument("--checkpointevery", type=int, help="Training batches between checkpoints, " \
+                                                            "default=10", default=10)
+    parser.add_argument("--batchsize", type=int, help="Number of files whose names are predicted " \
+                                                      "together, default=100", default=100)
+    parser.add_argument("--profile", type=str, help="File for a per file, per stage timing report, " \
+                                                    "written as CSV if the name ends in .csv and JSON otherwise")
+    parser.add_argument("--profiletop", type=int, help="Number of stages in the hotspot summary printed " \
+                                                       "with --profile, default=10", default=10)
     args = parser.parse_args()
+    profiler.enabled = bool(args.profile)
 
     #Create a list of files to redact.
     redfilelist = glob.glob(args.input + "*.txt.redacted")
@@ -265,52 +992,103 @@ if __name__ == '__main__':
     if args.pickle:
         log.info("Accessing pickled classifier...")
         try:
-            clf = joblib.load(args.pickle)
-        except:
-            print("Could not open pickle files in given directory, exiting...")
+            clf = load_model(args.pickle)
+        except Exception as e:
+            print("Could not open pickle files in given directory, exiting...", e.args)
             sys.exit(1)
     # If not using pickled classifier extract features from IMDB and build models
+    # Stream the IMDB files into an incrementally trained classifier
+    elif args.streaming:
+        log.info("Training a classifier on features streamed from IMDB...")
+        trainlist, testlist = imdb_filelists(args.traincount, args.testcount, args.seed)
+        clf = train_streaming(trainlist, testlist, args.workers, args.trainbatch, args.maxnames,
+                              args.checkpoint, args.checkpointevery, args.ner)
+        clf.metadata.update(traincount=args.traincount, testcount=args.testcount, seed=args.seed)
+        if args.savemodel:
+            log.info("Saving model to " + args.savemodel)
+            clf.save(args.savemodel)
     else:
-        log.info("Extracting features and labels from IMDB...")
-        trainFeatures, trainLabels, testFeatures, testLabels = setup_data(args.traincount, args.testcount)
+        if args.featurestore and FeatureStore.exists(args.featurestore, 'train') \
+                and FeatureStore.exists(args.featurestore, 'test'):
+            log.info("Loading features and labels from " + args.featurestore + "...")
+            train = FeatureStore.load(args.featurestore, 'train')
+            test = FeatureStore.load(args.featurestore, 'test')
+        else:
+            log.info("Extracting features and labels from IMDB...")
+            train, test = setup_data(args.traincount, args.testcount, args.workers, args.featurecache, args.seed,
+                                     args.ner)
+            if args.featurestore:
+                train.save(args.featurestore, 'train')
+                test.save(args.featurestore, 'test')
 
         # Generate classifier models, including best selection
         log.info("Building models...")
-        clfdict = build_models(trainFeatures, trainLabels, testFeatures, testLabels)
-        clf = clfdict['BESTMODEL']
+        clfdict = build_models(train.features, train.labels, test.features, test.labels, test.vocab,
+                               args.models.split(','), args.folds, args.workers, args.budget)
+        key = MODEL_CANDIDATES[clfdict['BESTNAME']][0]
+        clf = ModelArtifact(clfdict['BESTMODEL'], metadata=dict(
+            model=type(clfdict['BESTMODEL']).__name__, trainnames=len(train), testnames=len(test),
+            traincount=args.traincount, testcount=args.testcount, seed=args.seed,
+            score=clfdict['BESTSCORE'], cvscore=clfdict[key + 'CVSCORE'], folds=args.folds, ner=args.ner,
+            **clfdict[key + 'TIMING']))
+        if args.savemodel:
+            log.info("Saving model to " + args.savemodel)
+            clf.save(args.savemodel)
 
-    # Run the redaction routines for the files in the list
-    for redfile in redfilelist:
-        # Read in document to be redacted into a string
-        try:
-            f = open(redfile)
-            raw = f.read()
-            f.close()
-        except:
-            print("File read error, exiting...")
-            sys.exit(1)
+    # Run the unredaction in batches of files, so that the names in a batch are
+    # predicted together
+    for b in range(0, len(redfilelist), args.batchsize):
+        batch = redfilelist[b:b + args.batchsize]
+        texts = []
+        for redfile in batch:
+            # Read in document to be unredacted into a string
+            profiler.current_file = redfile
+            try:
+                with profiler.stage('read'):
+                    f = open(redfile)
+                    texts.append(f.read())
+                    f.close()
+            except:
+                print("File read error, exiting...")
+                sys.exit(1)
 
-        # Create output file name
-        outname = re.sub(args.input, "", redfile) + ".unredacted"
-        outname = re.sub('.redacted.', '.', outname)
+        # Perform unredaction
+        log.info("Unredacting " + str(len(batch)) + " files...")
+        profiler.current_file = None
+        with profiler.stage('unredact_texts'):
+            newstrings = unredact_texts(texts, batch, clf)
 
-        # Open output file
-        try:
-            if args.output:
-                fileOut = open(os.path.join(args.output, outname), 'w', encoding='utf-8')
-            else:
-                fileOut = open(outname, 'w', encoding='utf-8')
-        except:
-            print("Could not open output file, was directory name in form of ./<name>?  Exiting...")
-            sys.exit(1)
+        for redfile, newstring in zip(batch, newstrings):
+            profiler.current_file = redfile
 
-        # Perform unredaction
-        log.info("Unredacting string from file...")
-        newstring = unredact_file(raw, redfile, clf)
+            # Create output file name
+            outname = re.sub(args.input, "", redfile) + ".unredacted"
+            outname = re.sub('.redacted.', '.', outname)
+
+            # Open output file
+            try:
+                if args.output:
+                    fileOut = open(os.path.join(args.output, outname), 'w', encoding='utf-8')
+                else:
+                    fileOut = open(outname, 'w', encoding='utf-8')
+            except:
+                print("Could not open output file, was directory name in form of ./<name>?  Exiting...")
+                sys.exit(1)
+
+            # Write unredacted string to the output file
+            log.info("Writing string to file...")
+            with profiler.stage('write'):
+                print(newstring, file=fileOut)
+                fileOut.close()
+    profiler.current_file = None
 
-        # Write redacted string to the output file
-        log.info("Writing string to file...")
-        print(newstring, file=fileOut)
-        fileOut.close()
+    # Write the timing report and print the hotspots
+    if args.profile:
+        try:
+            profiler.write(args.profile)
+        except Exception as e:
+            print("Error writing profile, exiting...", e.args)
+            sys.exit(1)
+        print(profiler.hotspots(args.profiletop))
 
     log.info("\nUnredactor complete\n")
@@ -1,3 +1,4 @@
+import re
 import redactor
 
 def test_word_counter():
@@ -30,4 +31,249 @@ def test_redact_concept():
 
 def test_redact_gender():
 	newstr = redactor.redact_gender("This, woman, is a gender to remove")
-	assert newstr == "This, <gender redacted>  is a gender to remove"
+	assert newstr == "This, <gender redacted>, is a gender to remove"
+
+def test_redact_regex():
+	newstr, counts = redactor.redact_regex("Call (301) 555-1212 or mjbeattie@ou.edu before 11/20/2001", ['phone', 'email', 'date'])
+	assert newstr == "Call <phone redacted> or <email redacted> before <date redacted>"
+	assert counts == {'phone': 1, 'email': 1, 'date': 1}
+
+def test_document_analysis():
+	analysis = redactor.DocumentAnalysis("This, Steve Rogers is a name.  He said \"hi\".")
+	assert analysis.sentences == ["This, Steve Rogers is a name.", "He said \"hi\"."]
+	for sent in analysis.tokens:
+		for token, start, end in sent:
+			assert analysis.text[start:end] in (token, '"')
+	assert redactor.word_counter(analysis) == redactor.word_counter(analysis.text)
+
+def test_stem_cache():
+	cache = redactor.StemCache(maxsize=2)
+	stems = cache.stems("child")
+	assert cache.stems("child") is stems
+	cache.stems("dog")
+	cache.stems("cat")
+	assert len(cache) == 2 and cache.hits == 1 and cache.misses == 3
+
+def test_term_matcher():
+	matcher = redactor.TermMatcher(['Ann', 'Anna', 'A.B. (Jr)'], wholewords=True)
+	newstr = matcher.sub(redactor.thorns, "Ann, Anna and Annabel met A.B. (Jr)")
+	assert newstr == "\xfe\xfe\xfe, \xfe\xfe\xfe\xfe and Annabel met \xfe\xfe\xfe\xfe\xfe\xfe\xfe\xfe\xfe"
+
+def test_redact_gender_termfile(tmpdir):
+	termfile = tmpdir.join("terms.txt")
+	termfile.write("# extra terms\nmadam\n")
+	newstr = redactor.redact_gender("He told Madam it was his", str(termfile))
+	assert newstr == "<gender redacted> told <gender redacted> it was <gender redacted>"
+
+def test_redact_concept_special_characters():
+	newstr = redactor.redact_concept("A child (aged 3) was here.  The dog [a puppy] is not.", "child")
+	assert newstr == "<concept sentence redacted>  The dog [a puppy] is not."
+
+def test_redaction_result():
+	text = "Call (301) 555-1212, she said."
+	result = redactor.RedactionResult(text, redactor.scan_regex(text, ['phone']) + redactor.find_gender_spans(text), ['phone', 'gender'])
+	assert result.redacted == "Call <phone redacted>, <gender redacted> said."
+	assert result.spans[0] == (5, 19, 'phone', 14)
+	assert result.summarystats == [["Phone numbers", 1], ["Gender identifiers", 1]]
+	assert result.redacted_words == redactor.word_counter(result.redacted)
+
+def test_profiler():
+	profiler = redactor.Profiler()
+	with profiler.stage('off'):
+		pass
+	assert profiler.rows() == []
+	profiler.enabled = True
+	profiler.current_file = 'a.txt'
+	for i in range(3):
+		with profiler.stage('regex'):
+			pass
+	rows = profiler.take()
+	assert [(row[0], row[1], row[2]) for row in rows] == [('a.txt', 'regex', 3)]
+	assert profiler.rows() == []
+
+def test_redact_files_overlapped(tmpdir):
+	indir = tmpdir.mkdir("in")
+	outdir = tmpdir.mkdir("out")
+	for i in range(5):
+		indir.join("doc%d.txt" % i).write("Call (301) 555-121%d now" % i)
+	indir.mkdir("bad.txt")
+	files = sorted(str(f) for f in indir.listdir())
+	options = redactor.redaction_options(phones=True)
+	options.input, options.output = str(indir) + "/", str(outdir)
+	results = redactor.redact_files_overlapped(files, options, prefetch=2)
+	assert results[str(indir.join("bad.txt"))][1].startswith("File read error")
+	assert outdir.join("doc3.txt.redacted").read() == "Call <phone redacted> now\n"
+	assert "Phone numbers:  1 redactions" in results[str(indir.join("doc3.txt"))][0]
+
+def test_redaction_manifest(tmpdir):
+	indir = tmpdir.mkdir("in")
+	outdir = tmpdir.mkdir("out")
+	indir.join("doc.txt").write("Call (301) 555-1212 now")
+	redfile = str(indir.join("doc.txt"))
+	options = redactor.redaction_options(phones=True)
+	options.input, options.output = str(indir) + "/", str(outdir)
+	manifest = redactor.RedactionManifest(str(outdir), redactor.options_fingerprint(options)).load()
+	stats, errors = redactor.redact_files([redfile], options, manifest)
+	manifest.save()
+	assert manifest.unchanged(redfile, "doc.txt") == stats
+	options.dates = True
+	assert redactor.RedactionManifest(str(outdir), redactor.options_fingerprint(options)).load().unchanged(redfile, "doc.txt") is None
+
+def test_options_fingerprint():
+	options = redactor.redaction_options(phones=True)
+	fingerprint = redactor.options_fingerprint(options)
+	options.ner = "fast"
+	assert redactor.options_fingerprint(options) == fingerprint
+	options.stream, options.window = True, 1000
+	streamed = redactor.options_fingerprint(options)
+	assert streamed != fingerprint
+	options.window = 2000
+	assert redactor.options_fingerprint(options) != streamed
+
+def test_has_name_candidate():
+	stopwords = frozenset(['the', 'he', 'i'])
+	assert not redactor.has_name_candidate([("The", 0, 3), ("dog", 4, 7), ("ran", 8, 11)], stopwords)
+	assert redactor.has_name_candidate([("I", 0, 1), ("met", 2, 5), ("Steve", 6, 11)], stopwords)
+	assert not redactor.has_name_candidate([("Steve", 0, 5), ("ran", 6, 9)], stopwords, lambda start, end: start == 0)
+
+class CountingResources(redactor.NLPResources):
+	"""Tokenizes on whitespace, tags capitalized words as proper nouns and counts the sentences tagged and chunked"""
+	def __init__(self):
+		redactor.NLPResources.__init__(self)
+		self.tagged = 0
+		self.chunked = 0
+	def sent_tokenize(self, text):
+		return re.split(r"(?<=\.)\s+", text.strip())
+	def word_tokenize(self, sentence):
+		return re.findall(r"\w+|[^\w\s]", sentence)
+	def pos_tag_sents(self, sentences):
+		self.tagged += len(sentences)
+		return [[(word, "NNP" if word[0].isupper() and word not in ("The", "This") else "NN") for word in sent] for sent in sentences]
+	def ne_chunk_sents(self, tagged_sentences):
+		from nltk.tree import Tree
+		self.chunked += len(tagged_sentences)
+		trees = []
+		for sent in tagged_sentences:
+			tree = Tree("S", [])
+			for word, tag in sent:
+				if tag == "NNP" and len(tree) and isinstance(tree[-1], Tree):
+					tree[-1].append((word, tag))
+				else:
+					tree.append(Tree("PERSON", [(word, tag)]) if tag == "NNP" else (word, tag))
+			trees.append(tree)
+		return trees
+	def pos_tag(self, tokens):
+		return self.pos_tag_sents([tokens])[0]
+	def ne_chunk(self, tagged):
+		return self.ne_chunk_sents([tagged])[0]
+
+def test_fast_name_detector_per_document(monkeypatch):
+	monkeypatch.setattr(redactor.redactor, "_stopwords", frozenset(["the", "this"]))
+	nlp = CountingResources()
+	detector = redactor.FastNameDetector()
+	text = "Mary Smith ran.  The dog saw Mary Smith.  The end."
+	assert detector.find(text, redactor.DocumentAnalysis(text, nlp)) == ["Mary Smith"]
+	assert nlp.chunked == 1
+	assert list(detector.gazetteer.terms) == []
+	assert redactor.redaction_options().ner == "chunk"
+
+def test_fast_name_detector_many_names(monkeypatch):
+	monkeypatch.setattr(redactor.redactor, "_stopwords", frozenset(["the", "this"]))
+	class CallCountingResources(CountingResources):
+		calls = 0
+		def ne_chunk_sents(self, tagged_sentences):
+			self.calls += 1
+			return CountingResources.ne_chunk_sents(self, tagged_sentences)
+	nlp = CallCountingResources()
+	names = ["Q" + "".join(chr(97 + int(digit)) for digit in str(i)) for i in range(1023)]
+	text = "  ".join(name + " ran." for name in names) + "  " + "  ".join(name + " sat." for name in names)
+	assert redactor.FastNameDetector().find(text, redactor.DocumentAnalysis(text, nlp)) == names
+	assert nlp.chunked == 1023 and nlp.calls == 10
+
+def test_redact_documents_nlp():
+	nlp = CountingResources()
+	options = redactor.redaction_options(names=True)
+	results = redactor.redact_documents(["Mary Smith ran.", "Steve ran."], options, nlp)
+	assert [result.redacted for result in results] == ["\xfe" * 10 + " ran.", "\xfe" * 5 + " ran."]
+	assert redactor.redact_document("Ann sat.", options, nlp=nlp).redacted == "\xfe\xfe\xfe sat."
+	assert nlp.chunked == 3
+
+def test_fast_name_detector():
+	detector = redactor.FastNameDetector(["Steve Rogers"])
+	assert detector.find("The dog saw Steve Rogers.  The end.") == ["Steve Rogers"]
+	spans = redactor.find_name_spans("This, Steve Rogers is a name to remove", detector=detector)
+	assert [(span.start, span.end) for span in spans] == [(6, 18)]
+
+def test_document_analysis_resources():
+	class SplitResources(redactor.NLPResources):
+		def sent_tokenize(self, text):
+			return [sent.rstrip(".") + "." for sent in text.split(". ")]
+		def word_tokenize(self, sentence):
+			return sentence.replace(".", " .").split()
+	analysis = redactor.DocumentAnalysis("Steve ran. He fell.", SplitResources())
+	assert analysis.words == [["Steve", "ran", "."], ["He", "fell", "."]]
+	assert redactor.nlp_resources.word_tokenizer is redactor.nlp_resources.word_tokenizer
+
+def test_chunk_documents():
+	analyses = [redactor.DocumentAnalysis("This, Steve Rogers is a name."), redactor.DocumentAnalysis("The dog ran.  Mary Smith ran.")]
+	redactor.chunk_documents(analyses, [None, [1]])
+	assert sorted(analyses[1]._sentence_chunks) == [1]
+	assert [name for name, start, end in analyses[0].entities('PERSON', [0])] == ["Steve Rogers"]
+	assert [name for name, start, end in analyses[1].entities('PERSON', [1])] == ["Mary Smith"]
+	results = redactor.redact_documents(["This, Steve Rogers is a name to remove", "there are no names"], redactor.redaction_options(names=True))
+	assert [result.redacted for result in results] == ["This, \xfe\xfe\xfe\xfe\xfe\xfe\xfe\xfe\xfe\xfe\xfe\xfe is a name to remove", "there are no names"]
+
+def test_parse_concepts(tmpdir):
+	assert redactor.parse_concepts("child, dog,child") == ["child", "dog"]
+	conceptfile = tmpdir.join("concepts.txt")
+	conceptfile.write("# policy concepts\nchild\nmoney\n")
+	assert redactor.parse_concepts("@" + str(conceptfile)) == ["child", "money"]
+	assert redactor.parse_concepts(str(conceptfile)) == [str(conceptfile)]
+	assert redactor.redaction_options(concepts=["child", "dog"]).concepts == "child,dog"
+
+def test_concept_file_read_once(tmpdir, monkeypatch):
+	conceptfile = tmpdir.join("concepts.txt")
+	conceptfile.write("child\n")
+	reads = []
+	load_terms = redactor.redactor.load_terms
+	monkeypatch.setattr(redactor.redactor, "load_terms", lambda path: reads.append(path) or load_terms(path))
+	options = redactor.redaction_options(concepts="@" + str(conceptfile))
+	for i in range(3):
+		assert redactor.redact_document("This, child, is here.", options).redacted == "<concept sentence redacted>"
+	assert len(reads) == 1
+
+def test_redact_concepts():
+	result = redactor.redact_document("This, child, is here.  This, dog, is not.  The cat sat.", redactor.redaction_options(concepts="child,dog"))
+	assert result.redacted == "<concept sentence redacted>  <concept sentence redacted>  The cat sat."
+	assert result.summarystats == [["Concept sentences", 2], ["Concept sentences (child)", 1], ["Concept sentences (dog)", 1]]
+
+def test_chunk_documents_calls():
+	nlp = CountingResources()
+	texts = ["Mary Smith ran.  The dog sat.", "The cat saw John Brown.  The end."]
+	analyses = [redactor.DocumentAnalysis(text, nlp) for text in texts]
+	redactor.chunk_documents(analyses)
+	detector = redactor.ChunkNameDetector()
+	assert [detector.find(text, analysis) for text, analysis in zip(texts, analyses)] == [["Mary Smith"], ["John Brown"]]
+	assert (nlp.tagged, nlp.chunked) == (4, 4)
+
+def test_redaction_result_partial_overlap():
+	text = "Go to 12 Oak St now."
+	spans = [redactor.RedactionSpan(3, 11, 'concept', 8), redactor.RedactionSpan(6, 15, 'address', 9)]
+	result = redactor.RedactionResult(text, spans, ['concept', 'address'])
+	assert result.redacted == "Go <concept sentence redacted> now."
+	assert result.counts() == {'concept': 1, 'address': 0}
+
+def test_iter_windows_long_match():
+	import io
+	text = "Go to 1212 Mockingbird Lane, Los Angeles, CA 90001 now and then come back home again."
+	windows = list(redactor.iter_windows(io.StringIO(text), window=60, overlap=10, detectors=['address']))
+	assert "".join(windows) == text
+	assert any("1212 Mockingbird Lane, Los Angeles, CA 90001" in window for window in windows)
+
+def test_lru_cache():
+	cache = redactor.LRUCache(maxsize=2)
+	assert cache.get("a", lambda: 1) == 1
+	cache.get("b", lambda: 2)
+	assert cache.get("a", lambda: 3) == 1
+	cache.get("c", lambda: 4)
+	assert "a" in cache and "b" not in cache and len(cache) == 2
@@ -0,0 +1,102 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+from redactor import service
+
+
+def post(port, path, obj):
+    request = urllib.request.Request('http://127.0.0.1:%d%s' % (port, path), data=json.dumps(obj).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def test_service_redact():
+    svc = service.RedactionService(warm=False)
+    server = service.make_server(svc, port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.server_address[1]
+    try:
+        reply = post(port, '/redact', {'text': "Call (405) 555-1234 or mail joe@ou.edu", 'phones': True, 'emails': True})
+        assert reply['text'] == "Call <phone redacted> or mail <email redacted>"
+        assert ["Phone numbers", 1] in reply['stats']
+
+        try:
+            post(port, '/redact', {'text': "abc", 'colours': True})
+            assert False
+        except urllib.error.HTTPError as e:
+            assert e.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+        svc.close()
+
+
+def test_service_bad_requests(tmpdir):
+    tmpdir.join("terms.txt").write("bloke\n")
+    svc = service.RedactionService(warm=False, timeout=5, datadir=str(tmpdir))
+    server = service.make_server(svc, port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.server_address[1]
+    try:
+        for body in [{'text': 5, 'phones': True}, {'text': "abc", 'genderterms': ["x"]},
+                     {'text': "abc", 'phones': "yes"},
+                     {'text': "abc", 'genders': True, 'genderterms': "../terms.txt"},
+                     {'text': "abc", 'concepts': "@/etc/passwd"}]:
+            try:
+                post(port, '/redact', body)
+                assert False
+            except urllib.error.HTTPError as e:
+                assert e.code == 400
+        reply = post(port, '/redact', {'text': "A bloke and a man", 'genders': True, 'genderterms': "terms.txt"})
+        assert reply['text'] == "A <gender redacted> and a <gender redacted>"
+    finally:
+        server.shutdown()
+        server.server_close()
+        svc.close()
+    svc = service.RedactionService(warm=False)
+    svc.clf = object()
+    try:
+        for call in [lambda: svc.redact("abc", genders=True, genderterms=str(tmpdir.join("terms.txt"))),
+                     lambda: svc.unredact("abc", ""), lambda: svc.unredact("abc", "review.redacted"),
+                     lambda: svc.unredact(None, "4356_10.txt.redacted")]:
+            try:
+                call()
+                assert False
+            except ValueError:
+                pass
+    finally:
+        svc.close()
+
+
+def test_service_batcher_survives_errors():
+    import argparse
+    svc = service.RedactionService(warm=False, timeout=5)
+    try:
+        bad = service._PendingRequest("abc", argparse.Namespace(phones=[True]))
+        svc._queue.put(bad)
+        assert bad.done.wait(5) and bad.error is not None
+        assert svc.redact("Call (405) 555-1234", phones=True)['text'] == "Call <phone redacted>"
+    finally:
+        svc.close()
+
+
+def test_service_batch_failure_stays_with_request():
+    svc = service.RedactionService(warm=False, timeout=5, batchwait=0.5)
+    try:
+        options = service.redaction_options(phones=True)
+        requests = [service._PendingRequest(text, options) for text in ["Call (405) 555-1234", 5, "No phone"]]
+        for request in requests:
+            svc._queue.put(request)
+        assert all(request.done.wait(5) for request in requests)
+        assert requests[0].reply['text'] == "Call <phone redacted>"
+        assert requests[1].error is not None
+        assert requests[2].reply['text'] == "No phone"
+    finally:
+        svc.close()
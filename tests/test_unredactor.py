@@ -1,5 +1,6 @@
+import time
 import redactor
-import joblib
+import numpy as np
 from sklearn import tree
 
 def test_extract_features():
@@ -7,7 +8,127 @@ def test_extract_features():
     assert ef == ([[10,15],[10,12]],['Matthew Beattie', 'Mary Beattie'])
 
 
-def test_unredact_file():
-    clf = joblib.load('/projects/redactor/redactor/dtclf.pkl')
+def test_extract_features_ner(monkeypatch):
+    from nltk.tree import Tree
+
+    class CapitalResources(redactor.NLPResources):
+        def sent_tokenize(self, text):
+            return text.split("  ")
+
+        def word_tokenize(self, sentence):
+            return sentence.rstrip(".").split() + ["."]
+
+        def pos_tag_sents(self, sentences):
+            return [[(word, "NNP" if word[0].isupper() else "NN") for word in sent] for sent in sentences]
+
+        def ne_chunk_sents(self, tagged_sentences):
+            return [Tree("S", [Tree("PERSON", [tagged]) if tagged[1] == "NNP" else tagged for tagged in sent])
+                    for sent in tagged_sentences]
+
+    monkeypatch.setattr(redactor.redactor, "_stopwords", frozenset(["will"]))
+    text = "Will ran.  Mary sat."
+    assert redactor.extract_features(text, '1_10.txt', CapitalResources())[1] == ['Will', 'Mary']
+    assert redactor.extract_features(text, '1_10.txt', CapitalResources(), 'fast')[1] == ['Mary']
+
+
+def test_unredact_file(tmpdir):
+    model = str(tmpdir.join("dtclf.joblib"))
+    redactor.ModelArtifact(tree.DecisionTreeClassifier().fit([[10, 10], [10, 4]], ['John Wayne', 'Mary'])).save(model)
+    clf = redactor.load_model(model)
+    assert redactor.load_model(model) is clf
     newstr = redactor.unredact_file("A great actor is \xfe\xfe\xfe\xfe\xfe\xfe\xfe\xfe\xfe\xfe I think.",'4356_10.txt',clf)
     assert newstr == "A great actor is John Wayne I think."
+
+
+def test_unredact_texts():
+    clf = tree.DecisionTreeClassifier().fit([[10, 10], [10, 3], [2, 10]], ['John Wayne', 'Ann', 'Mae West..'])
+    newstrs = redactor.unredact_texts(["\xfe\xfe\xfe met \xfe\xfe\xfe\xfe\xfe\xfe\xfe\xfe\xfe\xfe.", "No names here."],
+                                      ['1_10.txt.redacted', '2_10.txt.redacted'], clf)
+    assert newstrs == ["Ann met John Wayne.", "No names here."]
+
+
+def test_extract_file_features_cache(tmpdir):
+    review = tmpdir.join("4356_10.txt")
+    review.write("There is Matthew Beattie here.")
+    cachefile = str(tmpdir.join("features.pkl"))
+    cache = {str(review): (review.mtime(), [[10, 15]], ['Matthew Beattie'])}
+    redactor.save_feature_cache(cache, cachefile)
+    store = redactor.extract_file_features([str(review)], 1, redactor.load_feature_cache(cachefile))
+    assert store.features.tolist() == [[10, 15]]
+    assert list(store.label_names()) == ['Matthew Beattie']
+
+
+def test_feature_store(tmpdir):
+    store = redactor.FeatureStore(np.array([[10, 15], [2, 3], [10, 15]], dtype=np.int32),
+                                  np.array([0, 1, 0], dtype=np.int32), ['Matthew Beattie', 'Ann'])
+    store.save(str(tmpdir), 'train')
+    loaded = redactor.FeatureStore.load(str(tmpdir), 'train')
+    assert isinstance(loaded.features, np.memmap)
+    assert list(loaded.label_names()) == ['Matthew Beattie', 'Ann', 'Matthew Beattie']
+    clfdict = redactor.build_models(loaded.features, loaded.labels, loaded.features, loaded.labels, loaded.vocab)
+    assert list(clfdict['DTCLF'].predict([[2, 3]])) == ['Ann']
+
+
+def test_train_streaming(tmpdir):
+    files = []
+    for i in range(4):
+        review = tmpdir.join("%d_10.txt" % i)
+        review.write("There is Matthew Beattie here.")
+        files.append(str(review))
+    checkpoint = str(tmpdir.join("checkpoint.joblib"))
+    model = redactor.train_streaming(files[:3], files[3:], batchsize=1, maxnames=10, checkpoint=checkpoint)
+    assert list(model.predict([[10, 15]])) == ['Matthew Beattie']
+    assert redactor.ModelArtifact.load(checkpoint).metadata['filesdone'] == 3
+
+
+def test_streaming_rows_memory(monkeypatch):
+    import tracemalloc
+    from sklearn.naive_bayes import MultinomialNB
+    assert redactor.streaming_rows(100000) * 100000 <= redactor.STREAMING_MAX_CELLS
+    assert redactor.streaming_rows(1024) == 2 * redactor.streaming_rows(2048)
+    assert redactor.streaming_rows(10, batchsize=500) == 500
+    monkeypatch.setattr(redactor.unredactor, 'STREAMING_MAX_CELLS', 2 ** 16)
+    classes = np.arange(20000)
+    clf = MultinomialNB()
+    clf.partial_fit(np.array([[1, 2], [3, 1], [2, 2]]), classes[:3], classes=classes)
+    tracemalloc.start()
+    predictions = redactor.predict_rows(clf, np.ones((1000, 2), dtype=np.int32))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(predictions) == 1000
+    # Predicting all 1000 rows at once would need 1000 x 20000 x 8 bytes = 160 MB
+    assert peak < 20e6
+
+
+def test_build_models_cross_validation():
+    features = [[10, 10], [10, 4], [2, 10], [2, 4]] * 5
+    labels = ['John Wayne', 'Mary', 'Mae West..', 'Ann'] * 5
+    clfdict = redactor.build_models(features, labels, features, labels, candidates=['bayes', 'svm', 'tree'], folds=2)
+    assert clfdict['BESTNAME'] == 'tree'
+    assert clfdict['DTSCORE'] == 1.0 and clfdict['DTCVSCORE'] == 1.0
+    assert 'fit_seconds' in clfdict['SVMTIMING']
+    assert list(clfdict['BESTMODEL'].predict([[2, 4]])) == ['Ann']
+
+
+class SlowTree(tree.DecisionTreeClassifier):
+    def fit(self, X, y):
+        time.sleep(5 if self.max_depth == 1 else 0.4)
+        return tree.DecisionTreeClassifier.fit(self, X, y)
+
+
+def test_build_models_budget(monkeypatch):
+    monkeypatch.setattr(redactor.unredactor, 'make_model',
+                        lambda name: SlowTree(max_depth=1 if name == 'svm' else None))
+    features = [[10, 10], [10, 4], [2, 10], [2, 4]]
+    labels = ['John Wayne', 'Mary', 'Mae West..', 'Ann']
+    start = time.time()
+    clfdict = redactor.build_models(features, labels, features, labels, candidates=['bayes', 'svm', 'tree'],
+                                    workers=1, budget=0.8)
+    assert time.time() - start < 4
+    assert 'BAYESCLF' in clfdict and 'DTCLF' in clfdict and 'SVMCLF' not in clfdict
+
+
+def test_extract_features_batch():
+    results = redactor.extract_features_batch(["There is Matthew Beattie here.", "There is nobody here.", "There is Mary Beattie here."],
+                                              ['4356_10.txt', '12_3.txt', '7_8.txt'])
+    assert results == [([[10, 15]], ['Matthew Beattie']), ([], []), ([[8, 12]], ['Mary Beattie'])]